@@ -3,62 +3,430 @@
 # Chernobyl Fairy Pool Extractor
 # Extract sprites from <https://ocias.com/works/chernobyl-fairy-pool/>.
 
-import base64, json
+import base64, json, struct, time, argparse, contextlib, os, threading, re, \
+       hashlib, itertools, tempfile, multiprocessing
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from selenium import webdriver # https://selenium-python.readthedocs.io
 from PIL import Image # https://pypi.org/project/Pillow/
+import numpy as np # https://pypi.org/project/numpy/
 
 BUILDPATH = Path('build')
 BUILDPATH.mkdir(exist_ok=True)
 
-def retrieve_atlas():
+# Instrumentation, enabled with `--profile`: spans of time (`with
+# span('encode'):`) saved as a Chrome trace (see `save_trace`), and
+# counters, both summarized by `print_profile`.
+profiling = False
+trace_events = []
+counters = Counter()
+
+@contextlib.contextmanager
+def span(name, **args):
+    if not profiling:
+        yield
+        return
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        end = time.perf_counter_ns()
+        trace_events.append({
+            'name': name, 'ph': 'X', 'pid': os.getpid(),
+            'tid': threading.get_ident(), 'ts': start / 1000,
+            'dur': (end - start) / 1000, 'args': args,
+        })
+
+def count(name, n=1):
+    if profiling: counters[name] += n
+
+# Take the spans and counters recorded so far by a worker, to be merged in
+# the main process with `merge_profile`.
+def drain_profile():
+    global trace_events, counters
+    profile = (trace_events, counters)
+    trace_events = []
+    counters = Counter()
+    return profile
+
+def merge_profile(profile):
+    trace_events.extend(profile[0])
+    counters.update(profile[1])
+
+# Open with chrome://tracing or https://ui.perfetto.dev.
+def save_trace(path):
+    with path.open(mode='w') as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+# Spans by name (nested spans are included in their parents' time), then
+# counters.
+def print_profile():
+    spans = defaultdict(list)
+    for event in trace_events:
+        spans[event['name']].append(event['dur'] / 1e6)
+    print(f'{"span":12} {"count":>8} {"total (s)":>10} {"max (ms)":>10}')
+    for name, times in sorted(spans.items(), key=lambda item: -sum(item[1])):
+        print(f'{name:12} {len(times):8} {sum(times):10.3f} '
+              f'{1e3 * max(times):10.3f}')
+    for name, n in counters.items():
+        print(f'{name}: {n}')
+
+# encoding profile -> (suffix, Pillow save options), `raw` being RGBA
+# pixels preceded by the size (2 little-endian uint32)
+PROFILES = {
+    'default': ('.png', {}),
+    'fast': ('.png', {'compress_level': 1}),
+    'small': ('.png', {'optimize': True}),
+    'raw': ('.rgba', None),
+}
+
+# Save `img` to `path` (without suffix) with `profile`, returns the time it
+# took.
+def save_img(img, path, profile='default'):
+    start = time.perf_counter()
+    suffix, options = PROFILES[profile]
+    path = path.with_name(path.name + suffix)
+    if options is None:
+        with span('write'), path.open(mode='wb') as f:
+            f.write(struct.pack('<II', *img.size))
+            f.write(img.convert('RGBA').tobytes())
+    else:
+        with span('encode'):
+            img.save(path, **options)
+    elapsed = time.perf_counter() - start
+    count('images_written')
+    if profiling: count('bytes_written', path.stat().st_size)
+    return elapsed
+
+URL = 'https://ocias.com/works/chernobyl-fairy-pool/'
+
+# Retrieve `atlas.png` and `atlas.json` from the page at `URL` with a
+# browser, or from a saved copy of the page (or of its script) at
+# `html_path`, which must contain them (see `parse_atlas_html`). They are
+# recorded in `atlas.source.json` along with their source and content hash,
+# and only retrieved again when the source changes, their content doesn't
+# match anymore or `refresh` is given.
+def retrieve_atlas(html_path=None, refresh=False):
+    source = URL
+    html = None
+    if html_path is not None:
+        with span('read'):
+            html = Path(html_path).read_text(encoding='utf8',
+                                             errors='replace')
+        source = 'sha256:' + hashlib.sha256(html.encode()).hexdigest()
+
+    record_path = BUILDPATH / 'atlas.source.json'
+    if not refresh and record_path.exists():
+        with span('check'):
+            with record_path.open() as f:
+                record = json.load(f)
+            if record.get('source') == source and all(
+                (BUILDPATH / name).exists()
+                and hash_file(BUILDPATH / name) == record.get(name)
+                for name in ('atlas.png', 'atlas.json')
+            ):
+                return
+
+    with span('fetch'):
+        atlas_png, atlas_data = parse_atlas_html(html) \
+                                if html is not None else fetch_atlas()
+    record = {'source': source}
+    for name, data in (('atlas.png', atlas_png),
+                       ('atlas.json', atlas_data.encode())):
+        write_file(BUILDPATH / name, data)
+        record[name] = hashlib.sha256(data).hexdigest()
+    write_file(record_path, json.dumps(record, indent=2).encode())
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with path.open(mode='rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+def write_file(path, data):
+    tmp_path = path.with_name(path.name + '.tmp')
+    tmp_path.write_bytes(data)
+    tmp_path.replace(path)
+
+# Returns the atlas image (PNG) and frames (JSON) of the live page.
+def fetch_atlas():
+    from selenium import webdriver # https://selenium-python.readthedocs.io
     driver = webdriver.Firefox(service_log_path=None)
-    driver.get('https://ocias.com/works/chernobyl-fairy-pool/')
+    driver.get(URL)
 
     # atlas image
     atlas_b64 = driver.execute_script('return atlasImage.src') \
                       .removeprefix('data:image/png;base64,')
     atlas_png = base64.b64decode(atlas_b64, validate=True)
-    with (BUILDPATH / 'atlas.png').open(mode='wb') as f:
-        f.write(atlas_png)
 
     # atlas.json
     atlas_data = driver.execute_script('return JSON.stringify(A.frames)')
-    with (BUILDPATH / 'atlas.json').open(mode='w') as f:
-        f.write(atlas_data)
 
     driver.quit()
+    return atlas_png, atlas_data
+
+# Returns the atlas image (PNG) and frames (JSON) found in a saved page or
+# script: the data URI assigned to `atlasImage.src` (or else the largest
+# PNG data URI), and the first `frames` object containing fairy parts.
+def parse_atlas_html(html):
+    uris = re.compile(r'data:image/png;base64,([A-Za-z0-9+/=\s\\]+)')
+    m = re.search(r'atlasImage\.src\s*=\s*["\']' + uris.pattern, html) \
+        or max(uris.finditer(html), default=None,
+               key=lambda m: len(m.group(1)))
+    if not m:
+        raise ValueError('atlas image not found')
+    atlas_b64 = re.sub(r'\s', '', re.sub(r'\\(.)', r'\1', m.group(1),
+                                          flags=re.S))
+    atlas_png = base64.b64decode(atlas_b64, validate=True)
+
+    decoder = json.JSONDecoder()
+    for m in re.finditer(r'["\']?frames["\']?\s*:\s*(?=\{)', html):
+        try:
+            frames, _ = decoder.raw_decode(html, m.end())
+        except json.JSONDecodeError:
+            continue
+        if any(key.startswith('FairyParts/') for key in frames):
+            return atlas_png, json.dumps(frames)
+    raise ValueError('atlas frames not found')
+
+# Parts of a fairy, composited in this order on a canvas of `CANVAS_SIZE`.
+PARTS = ('Wings', 'Hair', 'Arm', 'Leg', 'Torso', 'Head')
+PART_KEY = re.compile(rf'FairyParts/({"|".join(PARTS)})(\d+)$')
+CANVAS_SIZE = (400, 400)
 
-def extract_sprites():
-    atlas_img = Image.open(BUILDPATH / 'atlas.png').convert('RGBA')
-    with open(BUILDPATH / 'atlas.json') as f:
+# Parts of each fairy found in `atlas_json`, as views over `atlas` (a RGBA
+# array) along with their position on the canvas:
+# `{ fairy number: { part: (x, y, pixels) } }`.
+def index_parts(atlas, atlas_json):
+    fairies = defaultdict(dict)
+    for key, part_json in atlas_json.items():
+        if not (m := PART_KEY.match(key)): continue
+        frame = part_json['frame']
+        source = part_json['spriteSourceSize']
+        pixels = atlas[frame['y']:frame['y'] + source['h'],
+                       frame['x']:frame['x'] + source['w']]
+        fairies[m[2]][m[1]] = (source['x'], source['y'], pixels)
+    return dict(sorted(fairies.items(), key=lambda item: int(item[0])))
+
+# Composite `src` over `dst` in place (RGBA uint8 arrays of the same shape),
+# with the same integer arithmetic as Pillow's `alpha_composite`.
+def alpha_composite(dst, src):
+    sa = src[..., 3:].astype(np.uint32)
+    da = dst[..., 3:].astype(np.uint32)
+    outa255 = sa * 255 + da * (255 - sa)
+    coef1 = sa * (255 * 255 << 7) // np.maximum(outa255, 1)
+    coef2 = (255 << 7) - coef1
+    rgb = src[..., :3] * coef1 + dst[..., :3] * coef2 + (0x80 << 7)
+    rgb = (((rgb >> 8) + rgb) >> 8) >> 7
+    a = outa255 + 0x80
+    a = ((a >> 8) + a) >> 8
+    np.copyto(dst, np.concatenate((rgb, a), axis=-1), where=sa != 0)
+
+# Composite of `layers`, a tuple of (part, fairy) in `PARTS` order, as
+# (x, y, pixels) where pixels only cover the rects of the layers (clipped to
+# the canvas), or None if they are all outside of it. `fairies` are the
+# parts found by `index_parts`. Composites are memoized in `cache`, so that
+# variants sharing their first layers only composite them once.
+def composite_layers(fairies, layers, cache):
+    if not layers: return None
+    if (composite := cache.get(layers)) is not None:
+        cache.move_to_end(layers)
+        return composite
+
+    part, fairy = layers[-1]
+    x, y, pixels = fairies[fairy][part]
+    left, top = max(x, 0), max(y, 0)
+    right = min(x + pixels.shape[1], CANVAS_SIZE[0])
+    bottom = min(y + pixels.shape[0], CANVAS_SIZE[1])
+    below = composite_layers(fairies, layers[:-1], cache)
+    if right <= left or bottom <= top:
+        return below
+
+    if below:
+        x0, y0, below_pixels = below
+        x1 = x0 + below_pixels.shape[1]
+        y1 = y0 + below_pixels.shape[0]
+        x0, y0 = min(x0, left), min(y0, top)
+        x1, y1 = max(x1, right), max(y1, bottom)
+    else:
+        x0, y0, x1, y1 = left, top, right, bottom
+    out = np.zeros((y1 - y0, x1 - x0, 4), dtype=np.uint8)
+    if below:
+        bx, by, below_pixels = below
+        out[by - y0:by - y0 + below_pixels.shape[0],
+            bx - x0:bx - x0 + below_pixels.shape[1]] = below_pixels
+    alpha_composite(out[top - y0:bottom - y0, left - x0:right - x0],
+                    pixels[top - y:bottom - y, left - x:right - x])
+
+    composite = cache[layers] = (x0, y0, out)
+    while len(cache) > cache.maxsize:
+        cache.popitem(last=False)
+    return composite
+
+# Bounded least recently used cache of `composite_layers`.
+class CompositeCache(OrderedDict):
+    def __init__(self, maxsize=256):
+        super().__init__()
+        self.maxsize = maxsize
+
+# Composite `layers` (see `composite_layers`), crop it to its opaque pixels
+# (parts may have transparent margins), and append its mirror on the
+# right. Returns None if it's empty.
+def composite_fairy(fairies, layers, cache):
+    composite = composite_layers(fairies, layers, cache)
+    if composite is None: return None
+    out = composite[2]
+    rows = np.flatnonzero(out[..., 3].any(axis=1))
+    cols = np.flatnonzero(out[..., 3].any(axis=0))
+    if not len(rows): return None
+    out = out[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    return Image.fromarray(np.concatenate((out, out[:, ::-1]), axis=1),
+                           'RGBA')
+
+# Layers of a variant spec, `[FAIRY,]PART=FAIRY,...`: the parts of FAIRY
+# (if given) with some of them replaced by those of other fairies, e.g.
+# `03,Wings=07` or `Wings=07,Hair=03`. `*` stands for every fairy having
+# the part (or any part for the base FAIRY), the spec then giving several
+# variants. Returns a list of layers (see `composite_layers`).
+def parse_variant(spec, fairies):
+    numbers = { int(fairy): fairy for fairy in fairies }
+    def find_fairy(number, part=None):
+        if number == '*':
+            return [ fairy for fairy, parts in fairies.items()
+                     if part is None or part in parts ]
+        fairy = numbers.get(int(number)) if number.isdigit() else None
+        if fairy is None or (part and part not in fairies[fairy]):
+            raise ValueError(f'{spec}: no {part or "fairy"} {number}')
+        return [fairy]
+
+    bases = [None]
+    choices = {} # part -> fairies
+    for item in spec.split(','):
+        part, _, number = item.strip().rpartition('=')
+        if not part:
+            bases = find_fairy(number)
+        elif part in PARTS:
+            choices[part] = find_fairy(number, part)
+        else:
+            raise ValueError(f'{spec}: unknown part {part}')
+
+    variants = []
+    for base, *chosen in itertools.product(bases, *choices.values()):
+        chosen = dict(zip(choices, chosen))
+        variants.append(tuple(
+            (part, fairy) for part in PARTS
+            if (fairy := chosen.get(part, base)) and part in fairies[fairy]
+        ))
+    return variants
+
+# Atlas parts and composites of a worker, see `init_worker`.
+worker_fairies = None
+worker_cache = None
+
+# The atlas is shared with workers through mmap (`fpatlas`, a `.npy` file).
+def init_worker(fpatlas, atlas_json, profile):
+    global worker_fairies, worker_cache, profiling
+    worker_fairies = index_parts(np.load(fpatlas, mmap_mode='r'), atlas_json)
+    worker_cache = CompositeCache()
+    profiling = profile
+
+# Render `layers` and save them to `path` (without suffix), returns the time
+# spent encoding (None if the composite is empty) and the spans recorded.
+def render_variant(layers, path, profile, fairies=None, cache=None):
+    fairies = fairies or worker_fairies
+    cache = worker_cache if cache is None else cache
+    with span('composite', variant=path.name):
+        out_img = composite_fairy(fairies, layers, cache)
+    encode_time = None
+    if out_img is not None:
+        encode_time = save_img(out_img, path, profile)
+    return encode_time, drain_profile()
+
+# Render each fairy as `out{NN}`, or the given `variants` specs (see
+# `parse_variant`) in `variants/`, using `jobs` processes (`None`: one per
+# CPU). Variants are sorted so that those sharing their first layers are
+# rendered by the same process and share their composites.
+def extract_sprites(profile='default', variants=(), jobs=1):
+    start = time.perf_counter()
+    encode_time = 0
+    with span('decode'):
+        atlas = np.asarray(Image.open(BUILDPATH / 'atlas.png').convert('RGBA'))
+    with span('parse'), open(BUILDPATH / 'atlas.json') as f:
         atlas_json = json.load(f)
+    count('bytes_read', (BUILDPATH / 'atlas.png').stat().st_size
+                        + (BUILDPATH / 'atlas.json').stat().st_size)
+    fairies = index_parts(atlas, atlas_json)
+
+    if variants:
+        (BUILDPATH / 'variants').mkdir(exist_ok=True)
+        tasks = {} # layers -> output path
+        for spec in variants:
+            for layers in parse_variant(spec, fairies):
+                name = '_'.join(f'{part}{fairy}' for part, fairy in layers)
+                tasks[layers] = BUILDPATH / 'variants' / name
+        tasks = dict(sorted(tasks.items()))
+    else:
+        tasks = { tuple((part, fairy) for part in PARTS if part in parts):
+                  BUILDPATH / f'out{fairy.zfill(2)}'
+                  for fairy, parts in fairies.items() }
+
+    def done(path, result):
+        nonlocal encode_time
+        elapsed, profile = result
+        merge_profile(profile)
+        if elapsed is None:
+            print(f'warning: {path.name} is empty')
+        else:
+            encode_time += elapsed
+
+    if jobs == 1 or len(tasks) < 2:
+        cache = CompositeCache()
+        for layers, path in tasks.items():
+            done(path, render_variant(layers, path, profile, fairies, cache))
+    else:
+        jobs = jobs or os.cpu_count()
+        context = multiprocessing.get_context('forkserver')
+        with tempfile.TemporaryDirectory() as tmp_path:
+            fpatlas = Path(tmp_path) / 'atlas.npy'
+            np.save(fpatlas, atlas)
+            with ProcessPoolExecutor(jobs, mp_context=context,
+                initializer=init_worker,
+                initargs=(fpatlas, atlas_json, profiling)) as executor:
+                results = executor.map(render_variant, tasks, tasks.values(),
+                    itertools.repeat(profile),
+                    chunksize=max(1, len(tasks) // (4 * jobs)))
+                for path, result in zip(tasks.values(), results):
+                    done(path, result)
+
+    total_time = time.perf_counter() - start
+    print(f'sprites: {len(tasks)} in {total_time:.2f}s, '
+          f'{encode_time:.2f}s encoding')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-e', '--encoding', choices=PROFILES,
+        default='default', help='encoding of the sprites (default: default)')
+    parser.add_argument('--profile', action='store_true',
+        help='save a Chrome trace to build/trace.json and print a summary of '
+             'where time went')
+    parser.add_argument('--html', metavar='FILE',
+        help='read the atlas from a saved copy of the page (or of its script) '
+             'instead of the live page with a browser')
+    parser.add_argument('--refresh', action='store_true',
+        help='retrieve the atlas again even if it is already in build/')
+    parser.add_argument('--variant', action='append', default=[],
+        metavar='[FAIRY,]PART=FAIRY,...',
+        help='render a fairy made of the parts of others instead of the '
+             'fairies themselves, e.g. "03,Wings=07" or "Wings=*,Hair=03" '
+             '(* for all fairies having the part), repeatable')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of processes, 0 to use all CPUs (default: 1)')
+    args = parser.parse_args()
+    profiling = args.profile
 
-    for i in range(1, 21):
-        out_img = Image.new('RGBA', (400, 400))
-
-        for part_str in ('Wings', 'Hair', 'Arm', 'Leg', 'Torso', 'Head'):
-            part_key = f'FairyParts/{part_str}{str(i).zfill(2)}'
-            if part_key not in atlas_json: continue
-            part_json = atlas_json[part_key]
-            out_img.alpha_composite(atlas_img,
-                dest = (
-                    part_json['spriteSourceSize']['x'],
-                    part_json['spriteSourceSize']['y'],
-                ),
-                source = (
-                    part_json['frame']['x'],
-                    part_json['frame']['y'],
-                    part_json['frame']['x'] + part_json['spriteSourceSize']['w'],
-                    part_json['frame']['y'] + part_json['spriteSourceSize']['h']
-                ),
-            )
-
-        out_bbox = [*out_img.getbbox()]
-        out_bbox[2] = 2*out_bbox[2] - out_bbox[0]
-        out_img = out_img.crop(out_bbox)
-        out_img.alpha_composite(out_img.transpose(Image.FLIP_LEFT_RIGHT))
-        out_img.save(BUILDPATH / f'out{str(i).zfill(2)}.png')
-
-retrieve_atlas()
-extract_sprites()
+    retrieve_atlas(args.html, args.refresh)
+    extract_sprites(args.encoding, args.variant, args.jobs or None)
+    if profiling:
+        save_trace(BUILDPATH / 'trace.json')
+        print_profile()
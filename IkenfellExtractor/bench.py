@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Benchmark of the extractor stages on synthetic game data, so that they
+# can be measured without owning the game. Each stage runs in its own
+# process, which gives its peak RSS.
+
+import sys, struct, json, time, random, argparse, os, subprocess, tempfile
+from pathlib import Path
+import extract as ex
+
+# scale -> parameters of `generate`
+SCALES = {
+    'small': dict(rooms=100, tilesets=4, sprites=50, atlasSize=(512, 512)),
+    'medium': dict(rooms=1000, tilesets=16, sprites=500,
+                   atlasSize=(2048, 1024)),
+    'large': dict(rooms=5000, tilesets=64, sprites=2000,
+                  atlasSize=(4096, 2048)),
+}
+
+STAGES = ('images', 'atlas', 'sprites', 'tilesets', 'maps', 'stitch', 'repack')
+
+# Synthetic Ikenfell image: runs of random lengths (up to `maxRun`) of
+# random colors, a quarter of them transparent.
+def write_img(fpimg:Path, size, rng:random.Random, maxRun=40):
+    runs = [struct.pack('<II', *size)]
+    npixels = size[0] * size[1]
+    while npixels:
+        n = min(npixels, rng.randint(1, maxRun))
+        alpha = rng.choice((0, 128, 255, 255))
+        runs.append(struct.pack('B4B', n, rng.randrange(256),
+                                rng.randrange(256), rng.randrange(256), alpha))
+        npixels -= n
+    fpimg.write_bytes(b''.join(runs))
+
+def pack_string(s:str):
+    data = s.encode('utf8')
+    return bytes((len(data),)) + data
+
+# Synthetic game in `dpgame`: `Atlas/atlas.img` of `atlasSize`, 3
+# `Atlas/ending_*.img`, `Atlas/atlas.bin` (see `AtlasBin`) with `tilesets`
+# tilesets of 8x8 16px tiles and `sprites` standalone sprites, and
+# `Data/map.json` with `rooms` rooms, about a third of them sharing their
+# layers with another one, spread over areas of 50 rooms.
+def generate(dpgame:Path, rooms=100, tilesets=4, sprites=50,
+             atlasSize=(512, 512), seed=0):
+    rng = random.Random(seed)
+    (dpgame / 'Atlas').mkdir(parents=True, exist_ok=True)
+    (dpgame / 'Data').mkdir(parents=True, exist_ok=True)
+    write_img(dpgame / 'Atlas/atlas.img', atlasSize, rng)
+    for i in range(3):
+        write_img(dpgame / f'Atlas/ending_{i}.img', ex.Maps.SIZE, rng)
+
+    # Sprites are laid out in shelves of 32 pixels.
+    width, height = atlasSize
+    x = y = 0
+    def place(w, h):
+        nonlocal x, y
+        if x + w > width:
+            x = 0
+            y += 32
+        if y + h > height:
+            raise ValueError(f'sprites do not fit in a {width}x{height} atlas')
+        x += w
+        return (x - w) / width, y / height, x / width, (y + h) / height
+
+    spriteRecords = [] # (name, fields)
+    def add_sprite(name, w, h):
+        t0X, t0Y, t2X, t2Y = place(w, h)
+        spriteRecords.append((name, (w, h, t0X, t0Y, t2X, t2Y, w, h, 0, 0)))
+
+    cols = rows = 8
+    tilesetNames = [ f'tileset{i}' for i in range(tilesets) ]
+    for name in tilesetNames:
+        for row in range(rows):
+            for col in range(cols):
+                add_sprite(f'{name}_{col}_{row}', 16, 16)
+    for i in range(sprites):
+        add_sprite(f'sprite{i}', rng.randint(4, 32), rng.randint(4, 32))
+    rng.shuffle(spriteRecords)
+    indices = { name: i for i, (name, _) in enumerate(spriteRecords) }
+
+    data = [pack_string('atlas'),
+            ex.AtlasBin.HEADER.pack(0.5, 0.5, len(spriteRecords))]
+    for name, fields in spriteRecords:
+        data += [pack_string(name), ex.AtlasBin.SPRITE.pack(*fields)]
+    data.append(struct.pack('<I', tilesets))
+    for name in tilesetNames:
+        spriteIds = [ indices[f'{name}_{col}_{row}']
+                      for row in range(rows) for col in range(cols) ]
+        data += [pack_string(name),
+                 ex.AtlasBin.TILESET.pack(16, 16, cols, rows, len(spriteIds)),
+                 struct.pack(f'<{len(spriteIds)}I', *spriteIds),
+                 b'\0'] # not optimized
+    (dpgame / 'Atlas/atlas.bin').write_bytes(b''.join(data))
+
+    def layer(ntilesets):
+        names = rng.sample(tilesetNames, min(ntilesets, tilesets))
+        tiles = ( '' if rng.random() < 0.2 else
+                  f'{rng.randrange(len(names))}:{rng.randrange(cols * rows)}'
+                  for _ in range(ex.Maps.COLS * ex.Maps.ROWS) )
+        return ','.join(names), ','.join(tiles)
+
+    layouts = []
+    with open(dpgame / 'Data/map.json', 'w', encoding='utf8') as f:
+        f.write('[')
+        for i in range(rooms):
+            if layouts and rng.random() < 0.3:
+                gameTiles = rng.choice(layouts)
+            else:
+                tilesets0, tiles0 = layer(2)
+                tilesets1, tiles1 = ('', '')
+                if rng.random() < 0.8:
+                    tilesets1, tiles1 = layer(1)
+                gameTiles = dict(type='GameTiles', tilesets0=tilesets0,
+                                 tiles0=tiles0, tilesets1=tilesets1,
+                                 tiles1=tiles1)
+                layouts.append(gameTiles)
+            area, index = divmod(i, 50)
+            room = dict(area=area, room=f'{index % 10},{index // 10},0',
+                        ents=[dict(type='Door'), gameTiles])
+            f.write((',' if i else '') + json.dumps(room))
+        f.write(']')
+
+# Run `stage` on the game in `dpgame`, returns the time it took. The atlas
+# is loaded beforehand (except for the `atlas` stage which times it), and
+# rooms are rendered beforehand for `stitch`.
+def run_stage(stage:str, dpgame:Path, dpout:Path, jobs=1):
+    fpatlas = dpgame / 'Atlas/atlas.img'
+    fpbin = dpgame / 'Atlas/atlas.bin'
+    fpmaps = dpgame / 'Data/map.json'
+    if stage == 'images':
+        start = time.perf_counter()
+        ex.imgs2pngs(dpgame / 'Atlas', dpout, jobs=jobs)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    atlas = ex.Atlas(fpbin, ex.open_img(fpatlas))
+    if stage == 'atlas':
+        return time.perf_counter() - start
+
+    if stage == 'stitch':
+        ex.Maps(atlas, fpmaps).save(dpout, jobs=jobs)
+    start = time.perf_counter()
+    if stage == 'sprites':
+        atlas.saveStandaloneSprites(dpout)
+    elif stage == 'tilesets':
+        atlas.saveTilesets(dpout)
+    elif stage == 'maps':
+        ex.Maps(atlas, fpmaps).save(dpout, jobs=jobs)
+    elif stage == 'stitch':
+        ex.stitch_areas(dpout)
+    elif stage == 'repack':
+        atlas.saveRepacked(dpout)
+    return time.perf_counter() - start
+
+# Run `stage` in a new process, returns the time it took and the peak RSS
+# of the process in bytes.
+def measure_stage(stage:str, dpgame:Path, jobs=1):
+    with tempfile.TemporaryDirectory() as dpout:
+        process = subprocess.Popen(
+            [sys.executable, __file__, '--stage', stage, '--game', dpgame,
+             '--out', dpout, '--jobs', str(jobs)],
+            stdout=subprocess.PIPE)
+        output = process.stdout.read()
+        _, status, rusage = os.wait4(process.pid, 0)
+    if status:
+        raise RuntimeError(f'stage {stage} failed')
+    elapsed = json.loads(output.splitlines()[-1])
+    return elapsed, rusage.ru_maxrss * 1024 # KiB on Linux
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--scale', action='append', choices=SCALES,
+        help='scale of the synthetic game (repeatable, default: small)')
+    parser.add_argument('--stages', default=','.join(STAGES),
+        help='comma separated stages to run (default: all)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of processes of the images and maps stages')
+    parser.add_argument('-o', '--output', type=Path,
+        help='also save the results to this JSON file')
+    parser.add_argument('--stage', help=argparse.SUPPRESS)
+    parser.add_argument('--game', type=Path, help=argparse.SUPPRESS)
+    parser.add_argument('--out', type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # child process of `measure_stage`
+    if args.stage:
+        elapsed = run_stage(args.stage, args.game, args.out, args.jobs or None)
+        print(json.dumps(elapsed))
+        sys.exit()
+
+    stages = args.stages.split(',')
+    if unknown := set(stages) - set(STAGES):
+        parser.error(f'unknown stages: {", ".join(sorted(unknown))}')
+
+    results = []
+    print(f'{"scale":8} {"stage":10} {"time (s)":>10} {"peak RSS (MiB)":>15}')
+    for scale in args.scale or ['small']:
+        with tempfile.TemporaryDirectory() as dpgame:
+            generate(Path(dpgame), **SCALES[scale])
+            for stage in stages:
+                elapsed, rss = measure_stage(stage, dpgame, args.jobs)
+                results.append(dict(scale=scale, stage=stage, time=elapsed,
+                                    rss=rss))
+                print(f'{scale:8} {stage:10} {elapsed:10.3f} '
+                      f'{rss / (1 << 20):15.1f}')
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
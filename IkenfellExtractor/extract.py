@@ -1,114 +1,929 @@
 #!/usr/bin/env python3
 
-import sys, struct, io, re, json
+import sys, struct, io, re, json, time, argparse, mmap, multiprocessing, \
+       hashlib, functools, os, tempfile, zlib, shutil, pickle, bisect, \
+       fnmatch, contextlib, threading
 import operator as op
+from collections import OrderedDict, defaultdict, Counter
+from types import SimpleNamespace
+from array import array
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+                               as_completed, wait, FIRST_COMPLETED
 from PIL import Image
-import construct as cs
-
-# Convert Ikenfell images to PNGs.
-def imgs2pngs(dpin:Path, dpout:Path):
-    for fpimg in dpin.glob('*.img'):
-        with open(fpimg, 'rb') as f:
-            image = Image.frombytes(
-                mode = 'RGBA',
-                size = struct.unpack('<II', f.read(8)),
-                data = b''.join(
-                    n * rgba for n, rgba
-                    in struct.iter_unpack('B4s', f.read())
-                ),
-            )
-            image.save(dpout / f'i_{fpimg.stem}.png')
+try:
+    import numpy as np # https://pypi.org/project/numpy/
+except ImportError:
+    np = None
+
+# Build manifest, associating each output to the digest of the inputs it was
+# generated from, so that re-runs only generate outputs whose inputs changed.
+# File digests are cached as well and only recomputed when their size or
+# mtime change. A manifest without path is disabled: nothing is ever fresh.
+class Manifest:
+    def __init__(self, fp:Path=None, force=False):
+        self.fp = fp
+        self.force = force
+        self.files = {} # path -> [size, mtime, digest]
+        self.outputs = {} # output name -> digest
+        if fp and fp.exists():
+            data = json.loads(fp.read_text())
+            self.files = data['files']
+            if not force:
+                self.outputs = data['outputs']
+
+    def hashFile(self, fp:Path):
+        stat = fp.stat()
+        key = [stat.st_size, stat.st_mtime_ns]
+        if (cached := self.files.get(str(fp))) and cached[:2] == key:
+            return cached[2]
+        h = hashlib.blake2b()
+        with open(fp, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self.files[str(fp)] = [*key, digest]
+        return digest
+
+    # Digest of `inputs`: files, strings or other digests.
+    def digest(self, *inputs):
+        if not self.fp: return ''
+        h = hashlib.blake2b()
+        for value in inputs:
+            if isinstance(value, Path):
+                value = self.hashFile(value)
+            h.update(value.encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def isFresh(self, fpout:Path, digest:str):
+        return bool(self.fp) and self.outputs.get(fpout.name) == digest \
+               and fpout.exists()
+
+    def update(self, fpout:Path, digest:str):
+        self.outputs[fpout.name] = digest
+
+    def save(self):
+        if not self.fp: return
+        fptmp = self.fp.with_suffix('.tmp')
+        fptmp.write_text(json.dumps({
+            'files': self.files, 'outputs': self.outputs,
+        }))
+        fptmp.replace(self.fp)
+
+# Outputs a dry run would produce, counted by task (`task`, set before each
+# task runs) instead of being produced. The digests outputs would have
+# are kept in `outputs`, so that later tasks see them as changed.
+class DryRun:
+    def __init__(self):
+        self.task = None
+        self.files = Counter()
+        self.pixels = Counter()
+        self.outputs = {} # output name -> digest
+
+    def add(self, pixels:int, files=1):
+        self.files[self.task] += files
+        self.pixels[self.task] += pixels
+
+    def __str__(self):
+        totals = { **{ task: (n, self.pixels[task])
+                       for task, n in self.files.items() },
+                   'total': (sum(self.files.values()),
+                             sum(self.pixels.values())) }
+        return '\n'.join(f'{task}: {n} files, {pixels / 1e6:.1f} Mpx'
+                         for task, (n, pixels) in totals.items())
+
+# Instrumentation of the extraction: spans of time (`with
+# profiler.span('encode'):`) and counters (`profiler.count('imagesWritten')`),
+# recorded only when `enabled`. Spans are kept as Chrome trace events (see
+# `saveTrace`), and summarized by name with the counters (`__str__`).
+# Workers send theirs back to the main process, see `run_profiled`.
+# doc: https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+class Profiler:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = []
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def span(self, name:str, **args):
+        if not self.enabled: return contextlib.nullcontext()
+        return self.timeSpan(name, args)
+
+    @contextlib.contextmanager
+    def timeSpan(self, name:str, args):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            self.events.append({
+                'name': name, 'ph': 'X', 'pid': os.getpid(),
+                'tid': threading.get_ident(), 'ts': start / 1000,
+                'dur': (end - start) / 1000, 'args': args,
+            })
+
+    def count(self, name:str, n=1):
+        if not self.enabled: return
+        with self.lock:
+            self.counters[name] += n
+
+    # Take the events and counters recorded so far, see `merge`.
+    def drain(self):
+        events, counters = self.events, self.counters
+        self.events = []
+        self.counters = Counter()
+        return events, counters
+
+    def merge(self, profile):
+        events, counters = profile
+        self.events += events
+        with self.lock:
+            self.counters.update(counters)
+
+    # Save the spans as a Chrome trace, to be opened with chrome://tracing
+    # or https://ui.perfetto.dev.
+    def saveTrace(self, fp:Path):
+        fp.write_text(json.dumps({
+            'traceEvents': self.events, 'displayTimeUnit': 'ms',
+        }))
+
+    # Spans by name (count, total and max time, nested spans are included
+    # in their parents' time), then counters.
+    def __str__(self):
+        spans = defaultdict(list)
+        for event in self.events:
+            spans[event['name']].append(event['dur'] / 1e6)
+        lines = [f'{"span":12} {"count":>8} {"total (s)":>10} '
+                 f'{"mean (ms)":>10} {"max (ms)":>10}']
+        for name, times in sorted(spans.items(), key=lambda item:
+                                  -sum(item[1])):
+            lines.append(f'{name:12} {len(times):8} {sum(times):10.3f} '
+                         f'{1e3 * sum(times) / len(times):10.3f} '
+                         f'{1e3 * max(times):10.3f}')
+        lines += [ f'{name}: {n}' for name, n in self.counters.items() ]
+        return '\n'.join(lines)
+
+profiler = Profiler()
+
+def init_worker_profiler(enabled:bool):
+    profiler.enabled = enabled
+
+# Call `function` in a worker, returns its result along with the spans and
+# counters it recorded, to be merged into the main process' `profiler`.
+def run_profiled(function, *args):
+    return function(*args), profiler.drain()
+
+# Encoding of output images according to a profile (`PROFILES`): PNG with
+# Pillow's default settings, `fast` (lowest deflate level), `small`
+# (optimized, slowest), or `raw` RGBA for intermediate outputs, stored like
+# `open_img`'s cache. Outputs are named with the profile's `suffix`. The
+# time spent encoding is accumulated in `encodeTime`.
+class ImageWriter:
+    # name -> (suffix, Pillow save options, deflate level)
+    PROFILES = {
+        'default': ('.png', {}, 6),
+        'fast': ('.png', {'compress_level': 1}, 1),
+        'small': ('.png', {'optimize': True}, 9),
+        'raw': ('.rgba', None, None),
+    }
+
+    def __init__(self, profile='default'):
+        self.profile = profile
+        self.suffix, self.options, self.compressLevel = self.PROFILES[profile]
+        self.encodeTime = 0
+
+    # Save `img`, returns the time it took.
+    def save(self, img:Image.Image, fp:Path):
+        start = time.perf_counter()
+        if self.options is None:
+            with profiler.span('write'), open(fp, 'wb') as f:
+                f.write(struct.pack('<II', *img.size))
+                f.write(img.tobytes())
+        else:
+            with profiler.span('encode'):
+                img.save(fp, **self.options)
+        elapsed = time.perf_counter() - start
+        if profiler.enabled:
+            profiler.count('imagesWritten')
+            profiler.count('bytesWritten', fp.stat().st_size)
+        self.encodeTime += elapsed
+        return elapsed
+
+    # Writer of an image given row by row (see `PngWriter`).
+    def stream(self, fp:Path, size):
+        profiler.count('imagesWritten')
+        if self.options is None:
+            return RawWriter(fp, size)
+        return PngWriter(fp, size, self.compressLevel)
+
+    def addTime(self, elapsed):
+        self.encodeTime += elapsed
+
+# Open an output image, saved by `ImageWriter` with any profile.
+def open_output(fp:Path):
+    if fp.suffix == '.rgba':
+        return open_raw(fp)
+    return Image.open(fp)
+
+# An Ikenfell image starts with its size (2 little-endian uint32) followed by
+# RLE runs of pixels, each run being a count (uint8) and a RGBA color.
+# Returns the size of the image and its RGBA pixels.
+def decode_img(fpimg:Path):
+    with profiler.span('decode', file=fpimg.name):
+        return decode_img_data(fpimg)
+
+def decode_img_data(fpimg:Path):
+    with open(fpimg, 'rb') as f:
+        data = f.read()
+    profiler.count('bytesRead', len(data))
+    size = struct.unpack_from('<II', data)
+    npixels = size[0] * size[1]
+    if (len(data) - 8) % 5 != 0:
+        raise ValueError(f'{fpimg}: truncated run')
+
+    if np:
+        # View the runs as a structured array, then expand all of them at
+        # once into a single RGBA buffer.
+        runs = np.frombuffer(data, offset=8,
+                             dtype=[('n', np.uint8), ('rgba', 'S4')])
+        nruns = int(runs['n'].sum(dtype=np.uint64))
+        if nruns == npixels:
+            pixels = np.repeat(runs['rgba'], runs['n']).view(np.uint8)
+    else:
+        runs = struct.iter_unpack('B4s', memoryview(data)[8:])
+        pixels = b''.join(n * rgba for n, rgba in runs)
+        nruns = len(pixels) // 4
+
+    if nruns != npixels:
+        raise ValueError(f'{fpimg}: {nruns} pixels in runs, expected '
+                         f'{size[0]}x{size[1]}')
+    return size, memoryview(pixels)
+
+def read_img_size(fpimg:Path):
+    with open(fpimg, 'rb') as f:
+        return struct.unpack('<II', f.read(8))
+
+# Open a raw RGBA image (size header followed by the pixels) through mmap.
+# Data following the pixels (e.g. the key of `open_img`'s cache) is ignored.
+def open_raw(fpraw:Path):
+    with open(fpraw, 'rb') as f:
+        raw = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    size = struct.unpack_from('<II', raw)
+    pixels = memoryview(raw)[8:8 + 4 * size[0] * size[1]]
+    return Image.frombuffer('RGBA', size, pixels, 'raw', 'RGBA', 0, 1)
+
+# Open an Ikenfell image without any PNG round-trip. If `fpraw` is given,
+# the decoded pixels are cached there as raw RGBA (see `open_raw`), followed
+# by the size and mtime of `fpimg` (`RAWCACHEKEY`), and reused as long as
+# they match exactly, unless `refresh`. A cache of the wrong length (e.g.
+# truncated) is decoded again.
+RAWCACHEKEY = struct.Struct('<QQ')
+
+def open_img(fpimg:Path, fpraw:Path=None, refresh=False):
+    stat = fpimg.stat()
+    key = RAWCACHEKEY.pack(stat.st_size, stat.st_mtime_ns)
+    if fpraw and not refresh and fpraw.exists():
+        width, height = read_img_size(fpimg)
+        length = 8 + 4 * width * height
+        with open(fpraw, 'rb') as f:
+            header = f.read(8)
+            valid = f.seek(0, os.SEEK_END) == length + RAWCACHEKEY.size
+            if valid:
+                f.seek(length)
+                valid = f.read() == key
+        if valid and header == struct.pack('<II', width, height):
+            return open_raw(fpraw)
+
+    size, pixels = decode_img(fpimg)
+    if fpraw:
+        fptmp = fpraw.with_suffix('.tmp')
+        with open(fptmp, 'wb') as f:
+            f.write(struct.pack('<II', *size))
+            f.write(pixels)
+            f.write(key)
+        fptmp.replace(fpraw)
+    return Image.frombuffer('RGBA', size, pixels, 'raw', 'RGBA', 0, 1)
+
+def img2pngPath(fpimg:Path, dpout:Path, suffix='.png'):
+    return dpout / f'i_{fpimg.stem}{suffix}'
+
+# Convert an Ikenfell image to PNG (or the format of `writer`), returns the
+# time it took and the part of it spent encoding.
+def img2png(fpimg:Path, dpout:Path, writer=None):
+    writer = writer or ImageWriter()
+    start = time.perf_counter()
+    size, pixels = decode_img(fpimg)
+    image = Image.frombuffer('RGBA', size, pixels, 'raw', 'RGBA', 0, 1)
+    encodeTime = writer.save(image, img2pngPath(fpimg, dpout, writer.suffix))
+    return time.perf_counter() - start, encodeTime
+
+# Convert Ikenfell images to PNGs, using `jobs` processes (`None`: one per
+# CPU). The largest files are scheduled first so that `atlas.img` doesn't
+# end up being converted alone at the end. Images in `exclude` are skipped,
+# as well as those which are fresh according to `manifest`.
+def imgs2pngs(dpin:Path, dpout:Path, jobs=1, exclude=(), manifest=None,
+              dryRun=None, writer=None):
+    manifest = manifest or Manifest()
+    writer = writer or ImageWriter()
+    digests = {}
+    for fpimg in set(dpin.glob('*.img')) - set(exclude):
+        digest = manifest.digest(fpimg, writer.profile)
+        fpout = img2pngPath(fpimg, dpout, writer.suffix)
+        if not manifest.isFresh(fpout, digest):
+            digests[fpimg] = digest
+    fpimgs = sorted(digests, reverse=True,
+                    key=lambda fpimg: fpimg.stat().st_size)
+    if dryRun:
+        for fpimg in fpimgs:
+            width, height = read_img_size(fpimg)
+            dryRun.add(width * height)
+        return
+
+    def done(fpimg, elapsed):
+        manifest.update(img2pngPath(fpimg, dpout, writer.suffix),
+                        digests[fpimg])
+        print(f'{fpimg.name}: {elapsed:.2f}s')
+
+    if jobs == 1:
+        for fpimg in fpimgs:
+            elapsed, _ = img2png(fpimg, dpout, writer)
+            done(fpimg, elapsed)
+        return
+
+    # forkserver: the caller may be running threads, which don't mix with fork
+    context = multiprocessing.get_context('forkserver')
+    with ProcessPoolExecutor(jobs, mp_context=context,
+        initializer=init_worker_profiler, initargs=(profiler.enabled,)) \
+    as executor:
+        futures = { executor.submit(run_profiled, img2png, fpimg, dpout,
+                                    writer): fpimg
+                    for fpimg in fpimgs }
+        for future in as_completed(futures):
+            (elapsed, encodeTime), profile = future.result()
+            profiler.merge(profile)
+            writer.addTime(encodeTime) # spent by the worker's copy
+            done(futures[future], elapsed)
+
+# Bounded least recently used cache of sprite images, keyed by sprite index.
+class SpriteCache:
+    def __init__(self, maxsize:int):
+        self.maxsize = maxsize
+        self.imgs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+
+    # Return the image of sprite `index`, calling `crop(index)` on a miss.
+    def get(self, index, crop):
+        if (img := self.imgs.get(index)) is not None:
+            self.hits += 1
+            self.imgs.move_to_end(index)
+            return img
+
+        self.misses += 1
+        img = self.imgs[index] = crop(index)
+        self.nbytes += 4 * img.width * img.height
+        while len(self.imgs) > self.maxsize:
+            _, old = self.imgs.popitem(last=False)
+            self.nbytes -= 4 * old.width * old.height
+        return img
+
+    def __str__(self):
+        return (f'{len(self.imgs)} sprites ({self.nbytes} B), '
+                f'{self.hits} hits, {self.misses} misses')
+
+# Data of an atlas (`atlas.bin`): its sprites and tilesets, see the readme
+# for the format. Sprites are stored by columns: `spriteNames` and an
+# `array('f')` per attribute in `sprites`. Tilesets have the same
+# attributes as in the format.
+class AtlasBin:
+    SPRITEFIELDS = ('width', 'height', 't0X', 't0Y', 't2X', 't2Y',
+                    'trimWidth', 'TrimHeight', 'offsetX', 'offsetY')
+    HEADER = struct.Struct('<ffI') # whitePixelX, whitePixelY, nSprites
+    SPRITE = struct.Struct(f'<{len(SPRITEFIELDS)}f')
+    # tileWidth, tileHeight, cols, rows, nIds
+    TILESET = struct.Struct('<IIIII')
+
+    def __init__(self, data:bytes):
+        buf = memoryview(data)
+        self.name, pos = self.unpackString(buf, 0)
+        self.whitePixelX, self.whitePixelY, nSprites = \
+            self.HEADER.unpack_from(buf, pos)
+        pos += self.HEADER.size
+
+        # Sprite records are copied as is, then split into columns.
+        self.spriteNames = []
+        records = array('f')
+        for _ in range(nSprites):
+            name, pos = self.unpackString(buf, pos)
+            self.spriteNames.append(name)
+            records.frombytes(buf[pos:pos + self.SPRITE.size])
+            pos += self.SPRITE.size
+        if sys.byteorder != 'little': records.byteswap()
+        nFields = len(self.SPRITEFIELDS)
+        self.sprites = { field: records[i::nFields]
+                         for i, field in enumerate(self.SPRITEFIELDS) }
+
+        nTilesets, = struct.unpack_from('<I', buf, pos)
+        pos += 4
+        self.tilesets = []
+        for _ in range(nTilesets):
+            name, pos = self.unpackString(buf, pos)
+            tileWidth, tileHeight, cols, rows, nIds = \
+                self.TILESET.unpack_from(buf, pos)
+            pos += self.TILESET.size
+            spriteIds = array('I')
+            spriteIds.frombytes(buf[pos:pos + 4 * nIds])
+            if sys.byteorder != 'little': spriteIds.byteswap()
+            pos += 4 * nIds
+            optimized = None
+            if buf[pos]:
+                optimized = bytes(buf[pos + 1:pos + 1 + cols * rows])
+                pos += cols * rows
+            pos += 1
+            self.tilesets.append(SimpleNamespace(
+                name=name, tileWidth=tileWidth, tileHeight=tileHeight,
+                cols=cols, rows=rows, spriteIds=spriteIds,
+                optimized=optimized,
+            ))
+
+    @staticmethod
+    def unpackString(buf:memoryview, pos:int):
+        end = pos + 1 + buf[pos]
+        return str(buf[pos + 1:end], 'utf8'), end
+
+    # Parse `fpbin`, caching the result in `fpcache` which is used instead
+    # as long as `fpbin` doesn't change. Only the attributes are cached, so
+    # that the cache doesn't depend on the module name (`__main__` or not).
+    # An unreadable cache (e.g. truncated) is parsed again. With `readOnly`,
+    # the cache is used but never written.
+    @classmethod
+    def load(cls, fpbin:Path, fpcache:Path=None, readOnly=False):
+        stat = fpbin.stat()
+        key = (stat.st_size, stat.st_mtime_ns)
+        if fpcache and fpcache.exists():
+            try:
+                with open(fpcache, 'rb') as f:
+                    cachedKey, attrs = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError, ValueError):
+                cachedKey = None
+            if cachedKey == key:
+                atlasBin = cls.__new__(cls)
+                atlasBin.__dict__.update(attrs)
+                return atlasBin
+
+        with profiler.span('parse', file=fpbin.name), open(fpbin, 'rb') as f:
+            data = f.read()
+            profiler.count('bytesRead', len(data))
+            atlasBin = cls(data)
+        if fpcache and not readOnly:
+            fptmp = fpcache.with_suffix('.tmp')
+            with open(fptmp, 'wb') as f:
+                pickle.dump((key, vars(atlasBin)), f, pickle.HIGHEST_PROTOCOL)
+            fptmp.replace(fpcache)
+        return atlasBin
+
+# View on sprite `index` of `atlas`, exposing the sprite attributes (see
+# `AtlasBin`), and for tiles their position in their tileset (col, row, id).
+# Its image is only cropped from the atlas when `img` is accessed.
+class SpriteView:
+    __slots__ = ('atlas', 'index')
+
+    def __init__(self, atlas, index:int):
+        self.atlas = atlas
+        self.index = index
+
+    def __getattr__(self, name):
+        if name in AtlasBin.SPRITEFIELDS:
+            return self.atlas.bin.sprites[name][self.index]
+        raise AttributeError(name)
+
+    @property
+    def name(self): return self.atlas.bin.spriteNames[self.index]
+    @property
+    def col(self): return self.atlas.spriteTiles[self.index][0]
+    @property
+    def row(self): return self.atlas.spriteTiles[self.index][1]
+    @property
+    def id(self): return self.atlas.spriteTiles[self.index][2]
+
+    @property
+    def img(self):
+        return self.atlas.getSpriteImg(self.index)
 
 class Atlas:
-    BINFORMAT = cs.Struct(
-        'name' / cs.PascalString(cs.Byte, 'utf8'),
-        'whitePixelX' / cs.Float32l,
-        'whitePixelY' / cs.Float32l,
-        'nSprites' / cs.Int32ul,
-        'sprites' / cs.Array(cs.this.nSprites, cs.Struct(
-            'name' / cs.PascalString(cs.Byte, 'utf8'),
-            'width' / cs.Float32l,
-            'height' / cs.Float32l,
-            't0X' / cs.Float32l,
-            't0Y' / cs.Float32l,
-            't2X' / cs.Float32l,
-            't2Y' / cs.Float32l,
-            'trimWidth' / cs.Float32l,
-            'TrimHeight' / cs.Float32l,
-            'offsetX' / cs.Float32l,
-            'offsetY' / cs.Float32l,
-        )),
-        'nTilesets' / cs.Int32ul,
-        'tilesets' / cs.Array(cs.this.nTilesets, cs.Struct(
-            'name' / cs.PascalString(cs.Byte, 'utf8'),
-            'tileWidth' / cs.Int32ul,
-            'tileHeight' / cs.Int32ul,
-            'cols' / cs.Int32ul,
-            'rows' / cs.Int32ul,
-            'nIds' / cs.Int32ul,
-            'spriteIds' / cs.Array(cs.this.nIds, cs.Int32ul),
-            'isOptimized' / cs.Flag,
-            'optimized' / cs.If(cs.this.isOptimized, cs.Array(
-                cs.this.cols * cs.this.rows, cs.Flag)),
-        )),
-    ).compile()
-
-    # An Atlas is composed of the atlas image itself (`fpimg`) and its data
-    # (`fpbin`) containing the references to the original sprites and tilesets.
-    def __init__(self, fpbin:Path, fpimg:Path):
-        with open(fpbin, 'rb') as fAtlasBin:
-            binData = fAtlasBin.read()
-        self.bin = self.BINFORMAT.parse(binData)
-        self.img = Image.open(fpimg)
+    # An Atlas is composed of the atlas image itself (`img`, see `open_img`)
+    # and its data (`fpbin`) containing the references to the original sprites
+    # and tilesets. At most `cacheSize` sprite images are kept in memory.
+    # `digest` identifies the atlas content for `Manifest`s. The parsed data
+    # is cached in `fpbincache` (see `AtlasBin.load`, `readOnly`). Without
+    # `img`, only the sprite boxes are available, from the atlas `size`.
+    def __init__(self, fpbin:Path, img:Image.Image, cacheSize=4096,
+                 digest='', fpbincache:Path=None, readOnly=False, size=None):
+        self.bin = AtlasBin.load(fpbin, fpbincache, readOnly)
+        self.img = img
+        self.size = img.size if img else size
+        self.spriteImgs = SpriteCache(cacheSize)
+        self.digest = digest
 
         # Tilesets indexed by name and prepare tiles populating.
         self.tilesets = {}
         for ts in self.bin.tilesets:
             ts.sprites = {}
+            ts.sprite = None
             self.tilesets[ts.name] = ts
 
-        # Populate tilesets with their tiles and populate standalone sprites.
-        # Additional attributes are also added to sprites for convenience
-        # (col, row, id, img).
+        # Populate tilesets with their tiles and populate standalone sprites,
+        # all of them referenced through `SpriteView`s and indexed by name.
+        # The position of tiles in their tileset is kept in `spriteTiles`
+        # (sprite index -> (col, row, id)). Sprites named after a tileset
+        # (`tileset.sprite`) are neither tiles nor standalone sprites.
+        self.sprites = {}
         self.standaloneSprites = []
+        self.spriteTiles = {}
         reTileName = re.compile(r'(.*)_([0-9]*)_([0-9]*)$')
-        for sprite in self.bin.sprites:
-            sprite.img = self.getSpriteImg(sprite)
-            if m := reTileName.match(sprite.name):
+        for i, spriteName in enumerate(self.bin.spriteNames):
+            sprite = self.sprites[spriteName] = SpriteView(self, i)
+            if m := reTileName.match(spriteName):
                 name, col, row = m.groups()
                 tileset = self.tilesets[name]
-                sprite.col = int(col)
-                sprite.row = int(row)
-                sprite.id = (sprite.row * tileset.cols) + sprite.col
-                tileset.sprites[sprite.id] = sprite
+                col = int(col)
+                row = int(row)
+                id = (row * tileset.cols) + col
+                self.spriteTiles[i] = (col, row, id)
+                tileset.sprites[id] = sprite
+            elif tileset := self.tilesets.get(spriteName):
+                tileset.sprite = sprite
             else:
                 self.standaloneSprites.append(sprite)
+        self.sortedSpriteNames = sorted(self.sprites)
 
-    def getSpriteImg(self, sprite):
-        return self.img.crop((
-            int(sprite.t0X * self.img.width),
-            int(sprite.t0Y * self.img.height),
-            int(sprite.t2X * self.img.width),
-            int(sprite.t2Y * self.img.height),
-        ))
+    # Sprites whose name matches `pattern` (glob syntax, e.g. `ending_*`).
+    # Names are looked up in `sortedSpriteNames` from the prefix preceding
+    # the first wildcard, so that families of sprites are found without
+    # going through all of them.
+    def findSprites(self, pattern:str):
+        prefix = re.match(r'[^*?\[]*', pattern).group()
+        names = self.sortedSpriteNames
+        start = bisect.bisect_left(names, prefix)
+        end = bisect.bisect_left(names, prefix + '\U0010ffff', lo=start)
+        return [ self.sprites[name] for name
+                 in fnmatch.filter(names[start:end], pattern) ]
 
-    def saveStandaloneSprites(self, dpout:Path):
+    # Tile `id` of `tileset` (its index in the tileset: row * cols + col).
+    def getTile(self, tileset:str, id:int):
+        return self.tilesets[tileset].sprites.get(id)
+
+    # Compare the `spriteIds` of each tileset to the tiles found by name,
+    # yields (tileset name, missing sprite indices, unexpected sprite
+    # indices) for tilesets which don't match.
+    def checkSpriteIds(self):
+        for tileset in self.bin.tilesets:
+            expected = { sprite.index for sprite in tileset.sprites.values() }
+            actual = set(tileset.spriteIds)
+            if expected != actual:
+                yield tileset.name, expected - actual, actual - expected
+
+    def getSpriteImg(self, index:int):
+        return self.spriteImgs.get(index, self.cropSprite)
+
+    def getSpriteBox(self, index:int):
+        sprites = self.bin.sprites
+        width, height = self.size
+        return (
+            int(sprites['t0X'][index] * width),
+            int(sprites['t0Y'][index] * height),
+            int(sprites['t2X'][index] * width),
+            int(sprites['t2Y'][index] * height),
+        )
+
+    def cropSprite(self, index:int):
+        with profiler.span('crop'):
+            return self.img.crop(self.getSpriteBox(index))
+
+    def saveStandaloneSprites(self, dpout:Path, manifest=None, dryRun=None,
+                              writer=None):
+        manifest = manifest or Manifest()
+        writer = writer or ImageWriter()
+        digest = manifest.digest(self.digest, writer.profile)
         for sprite in self.standaloneSprites:
-            if sprite.name in self.tilesets: continue
-            sprite.img.save(dpout / f's_{sprite.name}.png')
+            fpout = dpout / f's_{sprite.name}{writer.suffix}'
+            if manifest.isFresh(fpout, digest): continue
+            if dryRun:
+                x0, y0, x1, y1 = self.getSpriteBox(sprite.index)
+                dryRun.add((x1 - x0) * (y1 - y0))
+                continue
+            writer.save(sprite.img, fpout)
+            manifest.update(fpout, digest)
 
-    def saveTilesets(self, dpout:Path):
+    # Save tilesets, only those in `names` if given.
+    def saveTilesets(self, dpout:Path, manifest=None, names=None, dryRun=None,
+                     writer=None):
+        manifest = manifest or Manifest()
+        writer = writer or ImageWriter()
+        digest = manifest.digest(self.digest, writer.profile)
         for tileset in self.bin.tilesets:
+            if names and tileset.name not in names: continue
+            fpout = dpout / f't_{tileset.name}{writer.suffix}'
+            if manifest.isFresh(fpout, digest): continue
             size = (tileset.tileWidth  * tileset.cols,
                     tileset.tileHeight * tileset.rows,)
+            if dryRun:
+                dryRun.add(size[0] * size[1])
+                continue
             img = Image.new('RGBA', size)
 
             for sprite in tileset.sprites.values():
                 position = (sprite.col * tileset.tileWidth,
                              sprite.row * tileset.tileHeight,)
                 img.paste(sprite.img, position)
-            img.save(dpout / f't_{tileset.name}.png')
+            writer.save(img, fpout)
+            manifest.update(fpout, digest)
+
+    # Pack the images of all sprites into pages of at most
+    # `pageSize`x`pageSize` pixels (see `SkylinePacker`), sprites with
+    # identical pixels sharing the same rect. Returns the pages, as
+    # (size, [(sprite, x, y)]), and the rect of each sprite by name as
+    # (page, x, y, width, height). Without `pixels`, sprites are only
+    # deduplicated by their box in the atlas, which doesn't need the atlas
+    # image and gives an upper bound of the pages (for dry runs).
+    def repack(self, pageSize=2048, pixels=True):
+        unique = {} # key -> (sprite, size)
+        keys = {} # sprite name -> pixels digest or atlas box
+        for name, sprite in self.sprites.items():
+            if pixels:
+                img = sprite.img
+                size = img.size
+                h = hashlib.blake2b(img.tobytes(), digest_size=16)
+                h.update(struct.pack('<II', *size))
+                keys[name] = h.digest()
+            else:
+                x0, y0, x1, y1 = keys[name] = self.getSpriteBox(sprite.index)
+                size = (x1 - x0, y1 - y0)
+            unique.setdefault(keys[name], (sprite, size))
+
+        # Tallest sprites first, each one in the first page it fits in.
+        packers = []
+        placements = [] # page -> [(sprite, x, y)]
+        rects = {} # key -> rect
+        for key, (sprite, (width, height)) in sorted(unique.items(),
+                reverse=True, key=lambda item: item[1][1][::-1]):
+            for page, packer in enumerate(packers):
+                if position := packer.insert(width, height): break
+            else:
+                page = len(packers)
+                packers.append(SkylinePacker(max(pageSize, width),
+                                             max(pageSize, height)))
+                placements.append([])
+                position = packers[page].insert(width, height)
+            placements[page].append((sprite, *position))
+            rects[key] = (page, *position, width, height)
+
+        pages = [ ((packer.usedWidth, packer.usedHeight), sprites)
+                  for packer, sprites in zip(packers, placements) ]
+        return pages, { name: rects[key] for name, key in keys.items() }
+
+    # Save the pages of `repack` as `r_page{n}.png`, and `r_index.json`
+    # giving for each sprite its rect, and for each tileset the names of
+    # its tiles by id, so that all of them are read from a few files.
+    def saveRepacked(self, dpout:Path, manifest=None, pageSize=2048,
+                     dryRun=None, writer=None):
+        manifest = manifest or Manifest()
+        writer = writer or ImageWriter()
+        fpindex = dpout / 'r_index.json'
+        digest = manifest.digest(self.digest, writer.profile, str(pageSize))
+        if manifest.isFresh(fpindex, digest): return
+
+        pages, rects = self.repack(pageSize, pixels=not dryRun)
+        print(f'repack: {len(rects)} sprites, {len(set(rects.values()))} '
+              f'distinct, {len(pages)} pages')
+        if dryRun:
+            for (width, height), _ in pages:
+                dryRun.add(width * height)
+            dryRun.add(0)
+            return
+
+        for fp in dpout.glob('r_page*'):
+            fp.unlink()
+        pageNames = []
+        for i, (size, sprites) in enumerate(pages):
+            pageimg = Image.new('RGBA', size)
+            for sprite, x, y in sprites:
+                pageimg.paste(sprite.img, (x, y))
+            pageNames.append(f'r_page{i}{writer.suffix}')
+            writer.save(pageimg, dpout / pageNames[-1])
+
+        fpindex.write_text(json.dumps({
+            'pages': pageNames,
+            'sprites': rects,
+            'tilesets': {
+                tileset.name: {
+                    'tileWidth': tileset.tileWidth,
+                    'tileHeight': tileset.tileHeight,
+                    'cols': tileset.cols,
+                    'rows': tileset.rows,
+                    'tiles': { id: sprite.name for id, sprite
+                               in sorted(tileset.sprites.items()) },
+                } for tileset in self.bin.tilesets
+            },
+        }, separators=(',', ':')))
+        manifest.update(fpindex, digest)
+
+# Skyline bin packer of rectangles in a `width`x`height` page. The top edge
+# of the rectangles packed so far is kept as segments `[x, y, width]`, a new
+# rectangle goes where its bottom is the highest (smallest y, then x) and
+# raises the segments it covers.
+class SkylinePacker:
+    def __init__(self, width:int, height:int):
+        self.width = width
+        self.height = height
+        self.skyline = [[0, 0, width]]
+        self.usedWidth = 0
+        self.usedHeight = 0
+
+    # Position (x, y) of a new `width`x`height` rectangle, None if it
+    # doesn't fit.
+    def insert(self, width:int, height:int):
+        if not width or not height: return (0, 0)
+        best = None # (bottom, x, y, segment index)
+        for i, (x, _, _) in enumerate(self.skyline):
+            if x + width > self.width: break
+            y = self.fit(i, width)
+            if y + height > self.height: continue
+            if best is None or (y + height, x) < best[:2]:
+                best = (y + height, x, y, i)
+        if best is None: return None
+
+        bottom, x, y, i = best
+        end = x + width
+        j = i
+        while j < len(self.skyline) and self.skyline[j][0] < end:
+            sx, sy, sw = self.skyline[j]
+            if sx + sw > end:
+                self.skyline[j] = [end, sy, sx + sw - end]
+                break
+            j += 1
+        self.skyline[i:j] = [[x, bottom, width]]
+        self.merge()
+        self.usedWidth = max(self.usedWidth, end)
+        self.usedHeight = max(self.usedHeight, bottom)
+        return (x, y)
+
+    # Lowest y at which a rectangle `width` wide fits from segment `i`.
+    def fit(self, i:int, width:int):
+        end = self.skyline[i][0] + width
+        y = 0
+        for sx, sy, sw in self.skyline[i:]:
+            if sx >= end: break
+            y = max(y, sy)
+        return y
+
+    # Merge neighbouring segments at the same height.
+    def merge(self):
+        merged = [self.skyline[0]]
+        for segment in self.skyline[1:]:
+            if segment[1] == merged[-1][1]:
+                merged[-1] = [merged[-1][0], merged[-1][1],
+                              merged[-1][2] + segment[2]]
+            else:
+                merged.append(segment)
+        self.skyline = merged
+
+# Tiles of all the `tileWidth`x`tileHeight` tilesets of `atlas` stacked in a
+# single array, so that a layer of `cols`x`rows` tiles is drawn at once by
+# gathering its tiles. The last tile of the stack is empty.
+# Like `Maps.drawLayer`, a layer referencing a tile missing from its tileset
+# raises a `KeyError`, instead of gathering an empty or unrelated tile.
+class TileStack:
+    # `tiles`: stacked tiles, `offsets`: (index of the first tile, number of
+    # tiles) of each tileset by name, `shape`: (rows, cols, tileHeight,
+    # tileWidth, 4), `valid`: whether each stacked tile has a sprite.
+    def __init__(self, tiles, offsets, shape, valid):
+        self.tiles = tiles
+        self.offsets = offsets
+        self.shape = shape
+        self.valid = valid
+
+    @classmethod
+    def fromAtlas(cls, atlas:Atlas, tileWidth, tileHeight, cols, rows):
+        with profiler.span('stack'):
+            return cls.stackAtlas(atlas, tileWidth, tileHeight, cols, rows)
+
+    @classmethod
+    def stackAtlas(cls, atlas:Atlas, tileWidth, tileHeight, cols, rows):
+        atlasarr = np.asarray(atlas.img)
+
+        # Tilesets with sprites not matching the tile size are left out.
+        offsets = {}
+        tiles = []
+        valid = []
+        for tileset in atlas.bin.tilesets:
+            ntiles = tileset.cols * tileset.rows
+            tsarr = np.zeros((ntiles, tileHeight, tileWidth, 4), np.uint8)
+            tsvalid = np.zeros(ntiles, bool)
+            for id, sprite in tileset.sprites.items():
+                x0, y0, x1, y1 = atlas.getSpriteBox(sprite.index)
+                if (x1 - x0, y1 - y0) != (tileWidth, tileHeight): break
+                tsarr[id] = atlasarr[y0:y1, x0:x1]
+                tsvalid[id] = True
+            else:
+                offsets[tileset.name] = (sum(map(len, tiles)), ntiles)
+                tiles.append(tsarr)
+                valid.append(tsvalid)
+        tiles.append(np.zeros((1, tileHeight, tileWidth, 4), np.uint8))
+        valid.append(np.ones(1, bool))
+        return cls(np.concatenate(tiles), offsets,
+                   (rows, cols, tileHeight, tileWidth, 4),
+                   np.concatenate(valid))
+
+    def supports(self, gameTiles):
+        return all(
+            name in self.offsets
+            for i in (0, 1) if gameTiles[f'tilesets{i}']
+            for name in gameTiles[f'tilesets{i}'].split(',')
+        )
+
+    # Returns layer `i` of `gameTiles` as a RGBA array, `None` if empty.
+    def getLayer(self, gameTiles, i):
+        tilesets = gameTiles[f'tilesets{i}']
+        if not tilesets: return None
+        offsets = tuple( self.offsets[ts] for ts in tilesets.split(',') )
+
+        indices = np.full(self.shape[0] * self.shape[1], len(self.tiles) - 1)
+        for j, tile in enumerate(gameTiles[f'tiles{i}'].split(',')):
+            if not tile: continue
+            tileseti, tilei = tile.split(':')
+            offset, ntiles = offsets[int(tileseti)]
+            tilei = int(tilei)
+            if not (0 <= tilei < ntiles and self.valid[offset + tilei]):
+                raise KeyError(tilei)
+            indices[j] = offset + tilei
+
+        rows, cols, tileHeight, tileWidth, _ = self.shape
+        return self.tiles[indices].reshape(self.shape) \
+                   .transpose(0, 2, 1, 3, 4) \
+                   .reshape(rows * tileHeight, cols * tileWidth, 4)
+
+    def drawLayers(self, gameTiles, dstimg):
+        for i in (0, 1):
+            layer = self.getLayer(gameTiles, i)
+            if layer is not None:
+                dstimg.alpha_composite(Image.fromarray(layer))
+
+# Room rendering process pool workers (see `Maps.save`) share the tiles of
+# the main process `TileStack` through a memory-mapped file.
+workerTileStack = None
+workerWriter = None
+
+def init_room_worker(fptiles:Path, offsets, shape, valid, writer,
+                     profiling):
+    global workerTileStack, workerWriter
+    tiles = np.load(fptiles, mmap_mode='r')
+    workerTileStack = TileStack(tiles, offsets, shape, valid)
+    workerWriter = writer
+    init_worker_profiler(profiling)
+
+# Render and save a room, returns the time spent encoding it.
+def render_room(gameTiles, fpout:Path):
+    roomimg = Maps.newRoomImg()
+    with profiler.span('composite'):
+        workerTileStack.drawLayers(gameTiles, roomimg)
+    return Maps.saveRoomImg(roomimg, fpout, workerWriter)
+
+# Iterate over the rooms of a map file (a JSON array of rooms) without
+# loading the whole file: it is read by chunks and rooms are decoded one at
+# a time. Entities other than `GameTiles` are discarded.
+def iter_rooms(fpjmaps:Path, chunkSize=1 << 16):
+    decoder = json.JSONDecoder()
+    reSeparators = re.compile(r'[\s,]*')
+    with open(fpjmaps, encoding='utf8') as f:
+        buf = f.read(chunkSize)
+        profiler.count('bytesRead', len(buf))
+        buf = buf.lstrip()
+        if not buf.startswith('['):
+            raise ValueError(f'{fpjmaps}: expected a JSON array')
+        pos = 1
+
+        while True:
+            pos = reSeparators.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == ']': return
+            try:
+                room, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Incomplete room, read more of the file (at least as much
+                # as already buffered so that huge rooms aren't re-decoded
+                # too many times).
+                chunk = f.read(max(chunkSize, len(buf) - pos))
+                profiler.count('bytesRead', len(chunk))
+                if not chunk: raise
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+
+            room['ents'] = [ ent for ent in room.get('ents', ())
+                             if ent['type'] == 'GameTiles' ]
+            yield room
 
 class Maps:
     COLS = 15
@@ -119,10 +934,10 @@ class Maps:
     HEIGHT = ROWS * TILEHEIGHT
     SIZE = (WIDTH, HEIGHT)
 
-    def __init__(self, atlas:Atlas, fpjmaps:Path):
+    def __init__(self, atlas:Atlas, fpjmaps:Path, writer=None):
         self.atlas = atlas
-        with open(fpjmaps) as fjmaps:
-            self.jmaps = json.load(fjmaps)
+        self.fpjmaps = fpjmaps
+        self.writer = writer or ImageWriter()
 
     def drawLayer(self, gameTiles, i, dstimg):
         tilesets = gameTiles[f'tilesets{i}']
@@ -139,27 +954,601 @@ class Maps:
                         (j // self.COLS) * self.TILEHEIGHT,)
             dstimg.alpha_composite(sprite.img, position)
 
+    # Layers are drawn with `tileStack` when possible (requires NumPy),
+    # otherwise tile by tile with Pillow, both producing identical images.
+    @functools.cached_property
+    def tileStack(self):
+        if not np: return None
+        return TileStack.fromAtlas(self.atlas, self.TILEWIDTH,
+                                   self.TILEHEIGHT, self.COLS, self.ROWS)
+
+    @staticmethod
+    def getGameTiles(room):
+        return next(ent for ent in room['ents'] if ent['type'] == 'GameTiles')
+
+    # The layers of a room are the only data its image depends on.
+    @staticmethod
+    def getLayers(gameTiles):
+        return ';'.join(gameTiles[key] for key
+                        in ('tilesets0', 'tiles0', 'tilesets1', 'tiles1'))
+
+    @classmethod
+    def newRoomImg(cls):
+        return Image.new('RGBA', cls.SIZE, color=(0, 0, 0, 255))
+
+    # Rooms are named `{area},{floor},{row},{col}`.
+    @staticmethod
+    def getRoomName(room):
+        col, row, floor = room['room'].split(',')
+        return f"{room['area']},{floor},{row},{col}"
+
+    @classmethod
+    def getRoomPath(cls, room, dpout:Path, suffix='.png'):
+        return dpout / f'm_{cls.getRoomName(room)}{suffix}'
+
     def getRoomImg(self, room):
-        roomimg = Image.new('RGBA', self.SIZE, color=(0, 0, 0, 255))
-        gameTiles = next(ent for ent in room['ents']
-                         if ent['type'] == 'GameTiles')
+        with profiler.span('composite'):
+            return self.drawRoomImg(room)
+
+    def drawRoomImg(self, room):
+        roomimg = self.newRoomImg()
+        gameTiles = self.getGameTiles(room)
+        if self.tileStack and self.tileStack.supports(gameTiles):
+            self.tileStack.drawLayers(gameTiles, roomimg)
+            return roomimg
+
         self.drawLayer(gameTiles, 0, roomimg)
         self.drawLayer(gameTiles, 1, roomimg)
         return roomimg
 
-    def save(self, dpout:Path):
-        for room in self.jmaps:
+    # Paths of the room images by (area, floor) then (row, col), like
+    # `index_rooms` but from the map instead of the saved images.
+    def indexRooms(self, dpout:Path):
+        areas = defaultdict(dict)
+        for room in iter_rooms(self.fpjmaps):
             if 'area' not in room: continue
-            col, row, floor = room['room'].split(',')
-            roomimg = self.getRoomImg(room)
-            roomimg.save(dpout / f"m_{room['area']},{floor},{row},{col}.png")
-
-dpin = Path('Ikenfell')
-dpout = Path('Out')
-dpout.mkdir(exist_ok=True)
-
-imgs2pngs(dpin / 'Atlas', dpout)
-atlas = Atlas(dpin / 'Atlas/atlas.bin', dpout / 'i_atlas.png')
-atlas.saveStandaloneSprites(dpout)
-atlas.saveTilesets(dpout)
-Maps(atlas, dpin / 'Data/map.json').save(dpout)
+            area, floor, row, col = map(int, self.getRoomName(room).split(','))
+            areas[area, floor][row, col] = self.getRoomPath(
+                room, dpout, self.writer.suffix)
+        return areas
+
+    # Room images may be hard links (see `save`), they are unlinked first so
+    # that saving a room doesn't overwrite its former duplicates. Returns the
+    # time spent encoding.
+    @staticmethod
+    def saveRoomImg(roomimg, fpout:Path, writer:ImageWriter):
+        fpout.unlink(missing_ok=True)
+        return writer.save(roomimg, fpout)
+
+    # Iterate over the rooms which need to be rendered, along with their
+    # output path and digest. Rooms which didn't change since the last run
+    # according to `manifest` are skipped. Rooms with the same layers as a
+    # previous one are skipped as well, to be linked to it (`self.links`).
+    # Only rooms for which `select(room)` is true are considered, if given.
+    def iterStaleRooms(self, dpout:Path, manifest:Manifest, select=None):
+        rendered = {} # layers digest -> output path
+        for room in iter_rooms(self.fpjmaps):
+            if 'area' not in room: continue
+            if select and not select(room): continue
+            fpout = self.getRoomPath(room, dpout, self.writer.suffix)
+            layers = self.getLayers(self.getGameTiles(room))
+            layersDigest = hashlib.blake2b(layers.encode()).digest()
+            digest = manifest.digest(self.atlas.digest, layers,
+                                     self.writer.profile)
+
+            if fpsrc := rendered.get(layersDigest):
+                if not manifest.isFresh(fpout, digest):
+                    self.links.append((fpsrc, fpout, digest))
+                self.duplicates[fpsrc.name].append(fpout.name)
+                self.stats['deduplicated'] += 1
+                continue
+            rendered[layersDigest] = fpout
+
+            if manifest.isFresh(fpout, digest):
+                self.stats['fresh'] += 1
+                continue
+            self.stats['rendered'] += 1
+            yield room, fpout, digest
+
+    # Rooms are saved individually, only those whose layers or atlas changed
+    # since the last run according to `manifest`, and only once per distinct
+    # layers. With more than one job (`None`: one per CPU), rooms are
+    # rendered on a process pool, except those the tile stack doesn't
+    # support which are rendered in this one.
+    # Duplicate rooms are hard linked to the first one with the same layers
+    # and listed in `m_duplicates.json`. `self.stats` counts rooms by outcome.
+    # With `select` (see `iterStaleRooms`), only the selected rooms are saved
+    # and `m_duplicates.json`, which lists all of them, is left as is.
+    def save(self, dpout:Path, manifest=None, jobs=1, select=None,
+             dryRun=None):
+        manifest = manifest or Manifest()
+        self.links = [] # (source, destination, digest)
+        self.duplicates = defaultdict(list) # source name -> duplicate names
+        self.stats = Counter()
+        rooms = self.iterStaleRooms(dpout, manifest, select)
+        if dryRun:
+            for room, fpout, digest in rooms:
+                dryRun.add(self.WIDTH * self.HEIGHT)
+                dryRun.outputs[fpout.name] = digest
+            dryRun.add(0, len(self.links))
+            for fpsrc, fpout, digest in self.links:
+                dryRun.outputs[fpout.name] = digest
+        else:
+            self.render(rooms, manifest, jobs)
+            self.saveLinks(dpout, manifest, select is None)
+        print('rooms: ' + ', '.join(
+            f'{n} {outcome}' for outcome, n in self.stats.items()))
+
+    def saveLinks(self, dpout:Path, manifest:Manifest, saveDuplicates:bool):
+        for fpsrc, fpout, digest in self.links:
+            fpout.unlink(missing_ok=True)
+            with profiler.span('link'):
+                try:
+                    os.link(fpsrc, fpout)
+                except OSError:
+                    shutil.copyfile(fpsrc, fpout)
+            manifest.update(fpout, digest)
+        if saveDuplicates:
+            (dpout / 'm_duplicates.json').write_text(
+                json.dumps(self.duplicates, indent=2))
+
+    def render(self, rooms, manifest:Manifest, jobs):
+        if jobs == 1 or not self.tileStack:
+            for room, fpout, digest in rooms:
+                self.saveRoomImg(self.getRoomImg(room), fpout, self.writer)
+                manifest.update(fpout, digest)
+            return
+
+        def collect(futures):
+            for future in futures:
+                encodeTime, profile = future.result()
+                # spent by the worker's copy of `self.writer`
+                self.writer.addTime(encodeTime)
+                profiler.merge(profile)
+                manifest.update(*pending.pop(future))
+
+        jobs = jobs or os.cpu_count()
+        context = multiprocessing.get_context('forkserver')
+        with tempfile.TemporaryDirectory() as dptmp:
+            fptiles = Path(dptmp) / 'tiles.npy'
+            np.save(fptiles, self.tileStack.tiles)
+            initargs = (fptiles, self.tileStack.offsets, self.tileStack.shape,
+                        self.tileStack.valid, self.writer, profiler.enabled)
+            with ProcessPoolExecutor(jobs, mp_context=context,
+                initializer=init_room_worker, initargs=initargs) as executor:
+                pending = {} # future -> (fpout, digest)
+                for room, fpout, digest in rooms:
+                    gameTiles = self.getGameTiles(room)
+                    if not self.tileStack.supports(gameTiles):
+                        self.saveRoomImg(self.getRoomImg(room), fpout,
+                                         self.writer)
+                        manifest.update(fpout, digest)
+                        continue
+
+                    future = executor.submit(run_profiled, render_room,
+                                             gameTiles, fpout)
+                    pending[future] = (fpout, digest)
+                    # bound the number of rooms in flight
+                    if len(pending) >= 4 * jobs:
+                        collect(wait(pending, return_when=FIRST_COMPLETED)[0])
+                collect(as_completed(pending))
+
+# PNG encoder writing RGBA rows as they come, so that an image doesn't have
+# to be held in memory as a whole to be saved.
+# doc: https://www.w3.org/TR/png/
+class PngWriter:
+    def __init__(self, fp:Path, size, compressLevel=6):
+        self.rowSize = 4 * size[0]
+        self.compressor = zlib.compressobj(compressLevel)
+        self.f = open(fp, 'wb')
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        # 8 bits depth, RGBA, deflate, adaptive filtering, no interlace
+        self.writeChunk(b'IHDR', struct.pack('>IIBBBBB', *size, 8, 6, 0, 0, 0))
+
+    def writeChunk(self, chunkType:bytes, data:bytes):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(chunkType)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(chunkType + data)))
+
+    # Write rows of RGBA pixels, each one prefixed with filter type 0 (none).
+    def write(self, rows:bytes):
+        data = b''.join(
+            b'\0' + rows[i:i + self.rowSize]
+            for i in range(0, len(rows), self.rowSize)
+        )
+        if compressed := self.compressor.compress(data):
+            self.writeChunk(b'IDAT', compressed)
+
+    def close(self):
+        self.writeChunk(b'IDAT', self.compressor.flush())
+        self.writeChunk(b'IEND', b'')
+        profiler.count('bytesWritten', self.f.tell())
+        self.f.close()
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+# Writer of raw RGBA rows, as `PngWriter` (see `open_raw` for the format).
+class RawWriter:
+    def __init__(self, fp:Path, size):
+        self.f = open(fp, 'wb')
+        self.f.write(struct.pack('<II', *size))
+
+    def write(self, rows:bytes):
+        self.f.write(rows)
+
+    def close(self):
+        profiler.count('bytesWritten', self.f.tell())
+        self.f.close()
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+# Room images of each area and floor saved by `Maps.save` with `suffix`, as
+# `{ (area, floor): { (row, col): fp } }`.
+def index_rooms(dpout:Path, suffix='.png'):
+    reRoom = re.compile(r'm_(-?\d+),(-?\d+),(-?\d+),(-?\d+)'
+                        + re.escape(suffix) + '$')
+    areas = defaultdict(dict)
+    for fp in dpout.glob(f'm_*{suffix}'):
+        if m := reRoom.match(fp.name):
+            area, floor, row, col = map(int, m.groups())
+            areas[area, floor][row, col] = fp
+    return areas
+
+# Stitch the rooms of each area and floor into a single image using their
+# coordinates, `a_{area},{floor}.png`. Images are written strip by strip, so
+# that only a row of rooms is in memory at a time. Missing rooms are left
+# transparent. With `pyramid`, zoom levels of each area are saved as well,
+# see `save_pyramid`. Only areas in `areas` are stitched, if given. Rooms
+# are read with `roomSuffix`, see `ImageWriter`. Rooms are those saved in
+# `dpout` (see `index_rooms`), or `roomIndex` if given, e.g. for dry runs
+# which don't save them (see `Maps.indexRooms`).
+def stitch_areas(dpout:Path, manifest=None, pyramid=False, areas=None,
+                 dryRun=None, writer=None, roomSuffix='.png', roomIndex=None):
+    manifest = manifest or Manifest()
+    writer = writer or ImageWriter()
+    outputs = manifest.outputs
+    if dryRun:
+        outputs = outputs | dryRun.outputs
+    if roomIndex is None:
+        roomIndex = index_rooms(dpout, roomSuffix)
+    for (area, floor), rooms in roomIndex.items():
+        if areas and area not in areas: continue
+        digest = manifest.digest(writer.profile, *(
+            outputs.get(fp.name, '') for fp in sorted(rooms.values())
+        ))
+        row0 = min(row for row, col in rooms)
+        col0 = min(col for row, col in rooms)
+        nrows = max(row for row, col in rooms) - row0 + 1
+        ncols = max(col for row, col in rooms) - col0 + 1
+        rooms = { (row - row0, col - col0): fp
+                  for (row, col), fp in rooms.items() }
+
+        fpout = dpout / f'a_{area},{floor}{writer.suffix}'
+        dppyramid = dpout / f'p_{area},{floor}'
+        if dryRun:
+            if not manifest.isFresh(fpout, digest):
+                dryRun.add(ncols * Maps.WIDTH * nrows * Maps.HEIGHT)
+            if pyramid and not manifest.isFresh(dppyramid, digest):
+                ntiles = sum(map(len, iter_pyramid_levels(rooms, nrows,
+                                                          ncols)))
+                dryRun.add(ntiles * Maps.WIDTH * Maps.HEIGHT, ntiles)
+            continue
+
+        if not manifest.isFresh(fpout, digest):
+            size = (ncols * Maps.WIDTH, nrows * Maps.HEIGHT)
+            with writer.stream(fpout, size) as out:
+                for row in range(nrows):
+                    with profiler.span('composite'):
+                        strip = Image.new('RGBA', (size[0], Maps.HEIGHT))
+                        for col in range(ncols):
+                            if fp := rooms.get((row, col)):
+                                with open_output(fp) as roomimg:
+                                    strip.paste(roomimg,
+                                                (col * Maps.WIDTH, 0))
+                    start = time.perf_counter()
+                    with profiler.span('encode'):
+                        out.write(strip.tobytes())
+                    writer.addTime(time.perf_counter() - start)
+            manifest.update(fpout, digest)
+
+        if pyramid and not manifest.isFresh(dppyramid, digest):
+            shutil.rmtree(dppyramid, ignore_errors=True)
+            save_pyramid(dppyramid, rooms, nrows, ncols, writer)
+            manifest.update(dppyramid, digest)
+
+# Positions (row, col) of the tiles of each zoom level of an area above
+# level 0, whose tiles are at the positions of `rooms` (see `save_pyramid`).
+# A tile exists when one of its 4 children does.
+def iter_pyramid_levels(rooms, nrows, ncols):
+    positions = set(rooms)
+    while nrows > 1 or ncols > 1:
+        nrows = (nrows + 1) // 2
+        ncols = (ncols + 1) // 2
+        positions = { (row // 2, col // 2) for row, col in positions }
+        yield positions
+
+# Save the zoom levels of an area in `dppyramid/{level}/{col},{row}.png`
+# (or the suffix of `writer`).
+# Level 0 is made of the room images themselves (`rooms`, see
+# `stitch_areas`), each tile of level n+1 is 4 tiles of level n scaled down
+# by half, until a single tile covers the whole area. Only 4 tiles are in
+# memory at a time.
+def save_pyramid(dppyramid:Path, rooms, nrows, ncols, writer=None):
+    writer = writer or ImageWriter()
+    tiles = rooms
+    level = 0
+    while nrows > 1 or ncols > 1:
+        nrows = (nrows + 1) // 2
+        ncols = (ncols + 1) // 2
+        level += 1
+        dplevel = dppyramid / str(level)
+        dplevel.mkdir(parents=True)
+        parents = {}
+        for row in range(nrows):
+            for col in range(ncols):
+                tileimg = Image.new('RGBA', (2 * Maps.WIDTH, 2 * Maps.HEIGHT))
+                children = ((dy, dx, tiles.get((2 * row + dy, 2 * col + dx)))
+                            for dy in (0, 1) for dx in (0, 1))
+                children = [ child for child in children if child[2] ]
+                if not children: continue
+                for dy, dx, fp in children:
+                    with open_output(fp) as childimg:
+                        tileimg.paste(childimg, (dx * Maps.WIDTH,
+                                                 dy * Maps.HEIGHT))
+                fp = parents[row, col] = dplevel / f'{col},{row}{writer.suffix}'
+                writer.save(tileimg.reduce(2), fp)
+        tiles = parents
+
+# Extraction of the game in `dpin` to `dpout`, split in tasks (`TASKS`)
+# which can be run selectively, each one only producing its own outputs
+# when they aren't fresh according to `manifest`. The atlas is shared by
+# tasks and only decoded if one of them needs it. Maps are restricted to
+# `areas` and to the rooms whose name matches one of the `rooms` patterns
+# (see `Maps.getRoomName`), tilesets to those in `tilesets`. With `dryRun`,
+# tasks count the outputs they would produce instead of producing them.
+# Images are encoded with `profile` (see `ImageWriter`), or the one given
+# for their task in `profiles`. The time each task took and the part of it
+# spent encoding (summed over workers) are kept in `times`, the time spent
+# saving images in the background by task in `backgroundTimes`.
+class Extraction:
+    # task -> tasks it depends on
+    TASKS = {
+        'images': (),
+        'sprites': (),
+        'tilesets': (),
+        'maps': (),
+        'stitch': ('maps',),
+        'repack': (),
+    }
+
+    def __init__(self, dpin:Path, dpout:Path, manifest:Manifest, jobs=1,
+                 areas=(), rooms=(), tilesets=(), pyramid=False,
+                 dryRun=None, profile='default', profiles={}):
+        self.dpin = dpin
+        self.dpout = dpout
+        self.manifest = manifest
+        self.jobs = jobs
+        self.areas = set(areas)
+        self.rooms = rooms
+        self.tilesetNames = set(tilesets)
+        self.pyramid = pyramid
+        self.dryRun = dryRun
+        self.fpatlas = dpin / 'Atlas/atlas.img'
+        self.fpatlasbin = dpin / 'Atlas/atlas.bin'
+        self.background = [] # (task, future, fpout, digest)
+        self.writers = { task: ImageWriter(profiles.get(task, profile))
+                         for task in self.TASKS }
+        self.times = {} # task -> time
+        self.backgroundTimes = defaultdict(float) # task -> time
+
+    # Tasks in `names` preceded by their dependencies.
+    @classmethod
+    def schedule(cls, names):
+        order = []
+        def visit(name):
+            if name in order: return
+            for dependency in cls.TASKS[name]:
+                visit(dependency)
+            order.append(name)
+        for name in names:
+            visit(name)
+        return order
+
+    def run(self, names):
+        with ThreadPoolExecutor(1) as self.backgroundPool:
+            for name in self.schedule(names):
+                if self.dryRun: self.dryRun.task = name
+                start = time.perf_counter()
+                with profiler.span(name):
+                    getattr(self, name)()
+                self.times[name] = time.perf_counter() - start
+                self.saveManifest()
+            for name, future, fpout, digest in self.background:
+                self.backgroundTimes[name] += future.result()
+                self.manifest.update(fpout, digest)
+        self.saveManifest()
+
+    # A dry run leaves the manifest as is, even with `force`.
+    def saveManifest(self):
+        if not self.dryRun: self.manifest.save()
+
+    def __str__(self):
+        lines = []
+        for name, elapsed in self.times.items():
+            lines.append(f'{name}: {elapsed:.2f}s, '
+                         f'{self.writers[name].encodeTime:.2f}s encoding')
+            if name in self.backgroundTimes:
+                lines.append(f'{name} (background): '
+                             f'{self.backgroundTimes[name]:.2f}s encoding')
+        return '\n'.join(lines)
+
+    # The decoded atlas is cached apart from the outputs, which with the
+    # `raw` profile include `i_atlas.rgba`: rewriting it would truncate the
+    # cache while it is mapped.
+    @functools.cached_property
+    def atlasimg(self):
+        return open_img(self.fpatlas, self.dpout / 'atlas.img.cache',
+                        refresh=self.manifest.force)
+
+    # A dry run neither decodes the atlas image nor writes caches, sprites
+    # are only measured from the atlas data and size.
+    @functools.cached_property
+    def atlas(self):
+        img = None if self.dryRun else self.atlasimg
+        atlas = Atlas(self.fpatlasbin, img,
+                      digest=self.manifest.digest(self.fpatlasbin,
+                                                  self.fpatlas),
+                      fpbincache=self.dpout / 'atlas.bin.cache',
+                      readOnly=bool(self.dryRun),
+                      size=read_img_size(self.fpatlas))
+        for name, missing, unexpected in atlas.checkSpriteIds():
+            print(f'warning: {name} spriteIds, {len(missing)} missing, '
+                  f'{len(unexpected)} unexpected')
+        return atlas
+
+    # The atlas PNG is written in the background while the other images
+    # are converted, by its own writer so that its encoding time is
+    # reported apart from the task's (see `backgroundTimes`).
+    def images(self):
+        writer = self.writers['images']
+        fpatlaspng = img2pngPath(self.fpatlas, self.dpout, writer.suffix)
+        digest = self.manifest.digest(self.fpatlas, writer.profile)
+        if not self.manifest.isFresh(fpatlaspng, digest):
+            if self.dryRun:
+                width, height = read_img_size(self.fpatlas)
+                self.dryRun.add(width * height)
+            else:
+                future = self.backgroundPool.submit(
+                    ImageWriter(writer.profile).save, self.atlasimg,
+                    fpatlaspng)
+                self.background.append(('images', future, fpatlaspng,
+                                        digest))
+        imgs2pngs(self.dpin / 'Atlas', self.dpout, jobs=self.jobs,
+                  exclude=(self.fpatlas,), manifest=self.manifest,
+                  dryRun=self.dryRun, writer=writer)
+
+    def sprites(self):
+        self.atlas.saveStandaloneSprites(self.dpout, self.manifest,
+                                         dryRun=self.dryRun,
+                                         writer=self.writers['sprites'])
+
+    def tilesets(self):
+        if unknown := self.tilesetNames - set(self.atlas.tilesets):
+            sys.exit(f'unknown tilesets: {", ".join(sorted(unknown))}')
+        self.atlas.saveTilesets(self.dpout, self.manifest,
+                                names=self.tilesetNames, dryRun=self.dryRun,
+                                writer=self.writers['tilesets'])
+
+    def maps(self):
+        select = None
+        if self.areas or self.rooms:
+            select = self.selectRoom
+        maps = Maps(self.atlas, self.dpin / 'Data/map.json',
+                    writer=self.writers['maps'])
+        maps.save(self.dpout, self.manifest, jobs=self.jobs, select=select,
+                  dryRun=self.dryRun)
+
+    def selectRoom(self, room):
+        if self.areas and int(room['area']) not in self.areas:
+            return False
+        name = Maps.getRoomName(room)
+        return not self.rooms or any(fnmatch.fnmatchcase(name, pattern)
+                                     for pattern in self.rooms)
+
+    def repack(self):
+        self.atlas.saveRepacked(self.dpout, self.manifest,
+                                dryRun=self.dryRun,
+                                writer=self.writers['repack'])
+
+    # A dry run hasn't saved the rooms, they are indexed from the map.
+    def stitch(self):
+        roomIndex = None
+        if self.dryRun:
+            maps = Maps(self.atlas, self.dpin / 'Data/map.json',
+                        writer=self.writers['maps'])
+            roomIndex = maps.indexRooms(self.dpout)
+        stitch_areas(self.dpout, self.manifest, pyramid=self.pyramid,
+                     areas=self.areas, dryRun=self.dryRun,
+                     writer=self.writers['stitch'],
+                     roomSuffix=self.writers['maps'].suffix,
+                     roomIndex=roomIndex)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of processes, 0 to use all CPUs (default: 1)')
+    parser.add_argument('-f', '--force', action='store_true',
+        help='regenerate all outputs, even those which are up to date')
+    parser.add_argument('--only', action='append', metavar='TASK',
+        choices=Extraction.TASKS,
+        help='only run this task (repeatable): %(choices)s (default: all '
+             'but stitch and repack, or those implied by --area, --room and '
+             '--tileset)')
+    parser.add_argument('--area', action='append', type=int, default=[],
+        help='only extract the rooms of this area (repeatable)')
+    parser.add_argument('--room', action='append', default=[],
+        metavar='AREA,FLOOR,ROW,COL',
+        help='only extract this room (repeatable, wildcards allowed)')
+    parser.add_argument('--tileset', action='append', default=[],
+        metavar='NAME', help='only extract this tileset (repeatable)')
+    parser.add_argument('--stitch', action='store_true',
+        help='stitch the rooms of each area and floor into a single image')
+    parser.add_argument('--pyramid', action='store_true',
+        help='with --stitch, also save zoom levels of each area')
+    parser.add_argument('--repack', action='store_true',
+        help='pack all sprites and tiles into a few pages with an index')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+        help='only report the number of files and pixels to produce')
+    parser.add_argument('--profile', action='store_true',
+        help='save a Chrome trace of the extraction to Out/trace.json and '
+             'print a summary of where time went')
+    parser.add_argument('-e', '--encoding', action='append', default=[],
+        metavar='[TASK=]PROFILE',
+        help='encoding of the images, of all tasks or of TASK (repeatable): '
+             + ', '.join(ImageWriter.PROFILES) + ' (default: default)')
+    args = parser.parse_args()
+
+    profile = 'default'
+    profiles = {}
+    for encoding in args.encoding:
+        task, _, name = encoding.rpartition('=')
+        if task and task not in Extraction.TASKS:
+            parser.error(f'unknown task {task}')
+        if name not in ImageWriter.PROFILES:
+            parser.error(f'unknown encoding profile {name}')
+        if task: profiles[task] = name
+        else: profile = name
+
+    tasks = args.only
+    if not tasks:
+        tasks = []
+        if args.tileset: tasks.append('tilesets')
+        if args.area or args.room: tasks.append('maps')
+        if not tasks: tasks = ['images', 'sprites', 'tilesets', 'maps']
+    if args.stitch: tasks.append('stitch')
+    if args.repack: tasks.append('repack')
+
+    dpout = Path('Out')
+    dpout.mkdir(exist_ok=True)
+    profiler.enabled = args.profile
+    extraction = Extraction(
+        Path('Ikenfell'), dpout,
+        Manifest(dpout / 'manifest.json', force=args.force),
+        jobs=args.jobs or None, areas=args.area, rooms=args.room,
+        tilesets=args.tileset, pyramid=args.pyramid,
+        dryRun=DryRun() if args.dry_run else None,
+        profile=profile, profiles=profiles,
+    )
+    extraction.run(tasks)
+    if args.dry_run:
+        print(extraction.dryRun)
+    else:
+        print(extraction)
+    if 'atlas' in vars(extraction):
+        print(f'sprite cache: {extraction.atlas.spriteImgs}')
+    if args.profile:
+        profiler.saveTrace(dpout / 'trace.json')
+        print(profiler)
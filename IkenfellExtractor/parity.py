@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Check that rooms drawn with the tile stack (`TileStack`) are identical to
+# rooms drawn tile by tile with Pillow (`Maps.drawLayer`), on a synthetic
+# game (see `bench.generate`), and that both reject the same invalid tiles.
+
+import sys, random, argparse, tempfile
+from pathlib import Path
+import extract as ex
+import bench
+
+def draw_pillow(maps:ex.Maps, gameTiles):
+    roomimg = maps.newRoomImg()
+    maps.drawLayer(gameTiles, 0, roomimg)
+    maps.drawLayer(gameTiles, 1, roomimg)
+    return roomimg
+
+def draw_stack(maps:ex.Maps, gameTiles):
+    roomimg = maps.newRoomImg()
+    maps.tileStack.drawLayers(gameTiles, roomimg)
+    return roomimg
+
+# Draw `gameTiles` with both paths, returns a description of the mismatch
+# or `None`. A path raising an exception is compared by exception type.
+def compare(maps:ex.Maps, gameTiles):
+    results = []
+    for draw in (draw_pillow, draw_stack):
+        try:
+            results.append(draw(maps, gameTiles).tobytes())
+        except Exception as e:
+            results.append(type(e))
+    pillow, stack = results
+    if pillow == stack: return None
+    if isinstance(pillow, bytes) and isinstance(stack, bytes):
+        return 'different images'
+    pillow, stack = ( 'an image' if isinstance(result, bytes)
+                      else result.__name__ for result in results )
+    return f'Pillow drew {pillow}, the tile stack {stack}'
+
+# Layers of a single tile of `tileset`: past the end of the tileset, before
+# its start, and `missingId` whose sprite was removed from the atlas.
+def invalid_layers(tileset, missingId, rng:random.Random):
+    for tilei in (tileset.cols * tileset.rows, -1, missingId):
+        tiles = [''] * (ex.Maps.COLS * ex.Maps.ROWS)
+        tiles[rng.randrange(len(tiles))] = f'0:{tilei}'
+        yield dict(type='GameTiles', tilesets0=tileset.name,
+                   tiles0=','.join(tiles), tilesets1='', tiles1='')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--scale', default='small', choices=bench.SCALES,
+        help='scale of the synthetic game (default: small)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if not ex.np:
+        sys.exit('the tile stack requires NumPy')
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as dpgame:
+        dpgame = Path(dpgame)
+        bench.generate(dpgame, seed=args.seed, **bench.SCALES[args.scale])
+        atlas = ex.Atlas(dpgame / 'Atlas/atlas.bin',
+                         ex.open_img(dpgame / 'Atlas/atlas.img'))
+        # Remove a tile, rooms using it must fail with both paths.
+        tileset = atlas.bin.tilesets[0]
+        missingId = rng.choice(sorted(tileset.sprites))
+        del tileset.sprites[missingId]
+        maps = ex.Maps(atlas, dpgame / 'Data/map.json')
+
+        failures = 0
+        nrooms = 0
+        for room in ex.iter_rooms(maps.fpjmaps):
+            nrooms += 1
+            if mismatch := compare(maps, maps.getGameTiles(room)):
+                failures += 1
+                print(f'{maps.getRoomName(room)}: {mismatch}')
+        for gameTiles in invalid_layers(tileset, missingId, rng):
+            nrooms += 1
+            if mismatch := compare(maps, gameTiles):
+                failures += 1
+                print(f'{gameTiles["tiles0"].strip(",")}: {mismatch}')
+
+    print(f'{nrooms} rooms, {failures} mismatches')
+    sys.exit(1 if failures else 0)
@@ -1,15 +1,93 @@
 #!/usr/bin/env python3
 
-import json, asyncio, datetime, sys, logging, os, subprocess, signal
+import json, asyncio, datetime, sys, logging, os, subprocess, signal, math
+import select, time, argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from gi.repository import GLib
 
-def sh_out(*args, **kwargs):
-    defaults = { 'check':True, 'capture_output':True, 'text':True, }
-    return subprocess.run(args, **(defaults | kwargs)).stdout
+# Run a program and return its output, it is killed if the calling task is
+# cancelled (e.g. by a block timeout).
+async def sh_out(*args, check=True):
+    process = await asyncio.create_subprocess_exec(*args,
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args, stdout,
+                                            stderr)
+    return stdout.decode()
+
+# Start a program without waiting for it (e.g. a GUI opened on click), away
+# from the stdin and stdout used by i3bar.
+async def sh_spawn(*args):
+    await asyncio.create_subprocess_exec(*args, stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL)
+
+# Human readable size in binary units (e.g. '9.5GiB', '23GiB'), rounded up
+# like `df -h`, or to the nearest like `free -h` without `round_up`.
+def human(nbytes, round_up=True):
+    rounding = math.ceil if round_up else round
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if nbytes < 1024 or unit == 'TiB': break
+        nbytes /= 1024
+    if unit == 'B': return f'{nbytes}B'
+    if (tenths := rounding(nbytes * 10)) < 100: return f'{tenths / 10}{unit}'
+    return f'{rounding(nbytes)}{unit}'
+
+# File of /proc kept open and read again from the start at each refresh,
+# /proc generates its content on each read so no fork or reopen is needed.
+class ProcFile:
+    def __init__(self, path, size=8192):
+        self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        self.size = size
+
+    def read(self):
+        return os.pread(self.fd, self.size, 0).decode()
+
+# Statistics of the handler runs of a block: latency histogram, errors,
+# timeouts and time of the last success.
+class BlockStats:
+    # upper bounds of the latency buckets in seconds
+    BUCKETS = (1e-4, 1e-3, 1e-2, 1e-1, 1, math.inf)
+
+    def __init__(self):
+        self.histogram = [0] * len(self.BUCKETS)
+        self.total = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.last_success = None
+
+    def add(self, elapsed):
+        self.total += elapsed
+        for i, bound in enumerate(self.BUCKETS):
+            if elapsed < bound:
+                self.histogram[i] += 1
+                break
+
+    def as_dict(self):
+        runs = sum(self.histogram)
+        labels = [ f'<{bound * 1000:g}ms' for bound in self.BUCKETS[:-1] ]
+        labels.append(f'>={self.BUCKETS[-2] * 1000:g}ms')
+        return {
+            'runs': runs,
+            'mean_ms': round(1000 * self.total / runs, 3) if runs else None,
+            'histogram': dict(zip(labels, self.histogram)),
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'since_success': None if self.last_success is None else
+                round(time.monotonic() - self.last_success, 3),
+        }
 
 # doc: https://i3wm.org/docs/i3bar-protocol.html#_blocks_in_detail
+# Handlers are coroutines run through `guard`: each gets at most `TIMEOUT`
+# seconds so that a slow probe can't stall the bar.
 class Block(dict):
+    TIMEOUT = 2
     DEFAULTS = {
         'full_text': '',
         'border': '#282828',
@@ -27,123 +105,281 @@ class Block(dict):
         self['name'] = self.__class__.__name__
         self['instance'] = str(id(self))
         self.statusline = statusline
+        self.cache = None
+        self.stats = BlockStats()
+
+    # Block serialized to json, only encoded again when it changed.
+    def to_json(self):
+        if self != self.cache:
+            self.cache = dict(self)
+            self.fragment = json.dumps(self)
+        return self.fragment
+
+    # Await `coroutine` within `TIMEOUT` seconds, a timeout or an error is
+    # logged and leaves the block as it was. The run is added to `stats`.
+    async def guard(self, coroutine):
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(coroutine, self.TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(f'{self["name"]} timed out')
+            self.stats.timeouts += 1
+        except Exception:
+            logging.exception(self['name'])
+            self.stats.errors += 1
+        else:
+            self.stats.last_success = time.monotonic()
+        self.stats.add(time.perf_counter() - start)
+
+    async def on_signal(self, sig): pass
+
+    async def on_click(self, event):
+        await self.refresh()
+
+    async def refresh(self): pass
+    async def out_loop(self): pass
 
-    def on_signal(self, sig): pass
+# Block polling a counter, every `INTERVALS[0]` seconds while it changes,
+# then backing off up to `INTERVALS[1]` seconds while it doesn't. `wake`
+# refreshes it immediately.
+class PolledBlock(Block):
+    INTERVALS = (5, 40)
 
-    def on_click(self, event):
-        self.out_once()
+    def __init__(self, statusline, **kwargs):
+        super().__init__(statusline, **kwargs)
+        self.woken = asyncio.Event()
 
-    def out_once(self): pass
-    async def out_loop(self): pass
+    def wake(self):
+        self.woken.set()
+
+    async def out_loop(self):
+        interval = self.INTERVALS[0]
+        while True:
+            text = self['full_text']
+            await self.guard(self.refresh())
+            if self.woken.is_set() or self['full_text'] != text:
+                interval = self.INTERVALS[0]
+            else:
+                interval = min(2 * interval, self.INTERVALS[1])
+            self.woken.clear()
+            try:
+                await asyncio.wait_for(self.woken.wait(), interval)
+            except asyncio.TimeoutError: pass
 
 class BDateTime(Block):
-    def out_once(self):
-        self.now = datetime.datetime.now()
-        self['full_text'] = self.now.strftime(' %Y/%m/%d  %H:%M')
+    async def refresh(self):
+        now = datetime.datetime.now()
+        self['full_text'] = now.strftime(' %Y/%m/%d  %H:%M')
         self.statusline.print()
 
     async def out_loop(self):
         while True:
-            self.out_once()
-            await asyncio.sleep(60 - self.now.second)
-
-class BDisk(Block):
-    def out_once(self):
-        available = sh_out('df', '-h', '/').splitlines()[1].split()[3]
-        self['full_text'] = f' {available}iB'
+            await self.guard(self.refresh())
+            await asyncio.sleep(60 - datetime.datetime.now().second)
+
+class BDisk(PolledBlock):
+    # /proc/self/mounts is flagged with EPOLLPRI when a filesystem is mounted
+    # or unmounted, its own epoll is readable by the event loop until the
+    # event is consumed.
+    def watch_mounts(self):
+        self.mounts = open('/proc/self/mounts')
+        self.epoll = select.epoll()
+        self.epoll.register(self.mounts, select.EPOLLPRI | select.EPOLLERR)
+        self.statusline.loop.add_reader(self.epoll.fileno(), self.on_mount)
+
+    def on_mount(self):
+        logging.debug(self.epoll.poll(0))
+        self.wake()
+
+    # statvfs blocks while the filesystem doesn't respond.
+    async def refresh(self):
+        stat = await self.statusline.run_blocking(os.statvfs, '/')
+        available = human(stat.f_bavail * stat.f_frsize)
+        self['full_text'] = f' {available}'
         self.statusline.print()
 
     async def out_loop(self):
-        while True:
-            self.out_once()
-            await asyncio.sleep(5)
+        self.watch_mounts()
+        await super().out_loop()
 
-class BRAM(Block):
-    def out_once(self):
-        available = sh_out('free', '-h').splitlines()[1].split()[6]
-        self['full_text'] = f' {available}B'
+class BRAM(PolledBlock):
+    def __init__(self, statusline, **kwargs):
+        super().__init__(statusline, **kwargs)
+        self.meminfo = ProcFile('/proc/meminfo')
+
+    async def refresh(self):
+        for line in self.meminfo.read().splitlines():
+            if line.startswith('MemAvailable:'):
+                available = human(int(line.split()[1]) * 1024, # kB
+                                  round_up=False)
+                break
+        self['full_text'] = f' {available}'
         self.statusline.print()
 
-    async def out_loop(self):
-        while True:
-            self.out_once()
-            await asyncio.sleep(5)
+class BCPU(PolledBlock):
+    def __init__(self, statusline, **kwargs):
+        super().__init__(statusline, **kwargs)
+        self.loadavg = ProcFile('/proc/loadavg')
 
-class BCPU(Block):
-    def out_once(self):
-        load = Path('/proc/loadavg').read_text().split()[1]
+    async def refresh(self):
+        load = self.loadavg.read().split()[1]
         self['full_text'] = f" {load}"
         self.statusline.print()
 
-    async def out_loop(self):
-        while True:
-            self.out_once()
-            await asyncio.sleep(5)
-
 class BNetwork(Block):
     ICONS = { 'none': '', 'limited': '', 'full': '', }
 
-    def on_click(self, event):
-        if event['button'] == 1:
-            subprocess.run(['nm-connection-editor'])
+    TIMEOUT = 5
 
-    def out_once(self):
-        connectivity = sh_out('nmcli', '--terse', 'general').split(':')[1]
-        connection = sh_out('nmcli', '--terse', 'connection', 'show',
-                            '--active').split(':')
+    async def on_click(self, event):
+        if event['button'] == 1:
+            await sh_spawn('nm-connection-editor')
+
+    async def refresh(self):
+        general, active = await asyncio.gather(
+            sh_out('nmcli', '--terse', 'general'),
+            sh_out('nmcli', '--terse', 'connection', 'show', '--active'))
+        connectivity = general.split(':')[1]
+        connection = active.split(':')
         interface = connection[3][:-1]
         name = connection[0]
         self['full_text'] = f'{self.ICONS[connectivity]} {interface} {name}'
         self.statusline.print()
 
+    # If `nmcli` can't be run, the block stays on its last value.
     async def out_loop(self):
-        self.out_once()
-        monitor = await asyncio.create_subprocess_shell('nmcli monitor',
-            stdout=subprocess.PIPE)
+        await self.guard(self.refresh())
+        try:
+            monitor = await asyncio.create_subprocess_exec('nmcli', 'monitor',
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        except OSError:
+            logging.exception('nmcli monitor')
+            return
         while line := await monitor.stdout.readline():
             logging.debug(line)
-            self.out_once()
+            await self.guard(self.refresh())
 
-class BVolume(Block):
+class BVolume(PolledBlock):
     ICONS = { 'false': '', 'true': '', }
 
-    def on_signal(self, sig):
+    async def on_signal(self, sig):
         if sig == signal.SIGRTMIN+15:
-            self.out_once()
+            await self.refresh()
 
-    def on_click(self, event):
+    async def on_click(self, event):
         if event['button'] == 1:
-            subprocess.run(['pamixer', '--toggle-mute'])
+            await sh_out('pamixer', '--toggle-mute', check=False)
         elif event['button'] == 3:
-            subprocess.run(['pavucontrol'])
+            await sh_spawn('pavucontrol')
         elif event['button'] == 4:
-            subprocess.run(['pamixer', '--increase', '5'])
+            await sh_out('pamixer', '--increase', '5', check=False)
         elif event['button'] == 5:
-            subprocess.run(['pamixer', '--decrease', '5'])
-        self.out_once()
+            await sh_out('pamixer', '--decrease', '5', check=False)
+        await self.refresh()
 
-    def out_once(self):
-        pamixer = sh_out('pamixer', '--get-mute', '--get-volume', check=False)
+    async def refresh(self):
+        pamixer = await sh_out('pamixer', '--get-mute', '--get-volume',
+                               check=False)
         mute = pamixer.split()[0]
         volume = pamixer.split()[1]
         self['full_text'] = f'{self.ICONS[mute]} {volume}%'
         self.statusline.print()
 
+    # Refresh on the change events of sinks, and of the server when the
+    # default sink changes. The subscription is restarted when it exits
+    # (e.g. the sound server restarted), after a delay backing off like the
+    # polling intervals. If `pactl` can't be run, the volume is polled.
     async def out_loop(self):
+        delay = self.INTERVALS[0]
         while True:
-            self.out_once()
-            await asyncio.sleep(5)
+            await self.guard(self.refresh())
+            try:
+                subscribe = await asyncio.create_subprocess_exec(
+                    'pactl', 'subscribe', stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE)
+            except OSError:
+                logging.exception('pactl subscribe, polling the volume')
+                return await super().out_loop()
+
+            start = time.monotonic()
+            while line := await subscribe.stdout.readline():
+                logging.debug(line)
+                if b' sink #' in line or b' server #' in line:
+                    await self.guard(self.refresh())
+            await subscribe.wait()
+            logging.warning(f'pactl subscribe exited ({subscribe.returncode})')
+            if time.monotonic() - start > self.INTERVALS[1]:
+                delay = self.INTERVALS[0]
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, self.INTERVALS[1])
+
+# Debug block showing the block with the slowest handlers on average, and
+# the errors and timeouts of all the blocks.
+class BStats(PolledBlock):
+    async def refresh(self):
+        stats = [ (block['name'], block.stats.as_dict())
+                  for block in self.statusline.blocks.values()
+                  if block is not self ]
+        name, slowest = max(stats, key=lambda s: s[1]['mean_ms'] or 0)
+        failures = sum(s['errors'] + s['timeouts'] for _, s in stats)
+        self['full_text'] = (f'{name} {slowest["mean_ms"] or 0:.1f}ms '
+                             f'{failures} failures')
+        self.statusline.print()
 
 # StatusLine is a status line following the i3bar input protocol.
 # * i3bar stdout: json click events -> stdin status_command
 # * status_command stdout: status line json -> read by i3bar
 # doc: https://i3wm.org/docs/i3bar-protocol.html
 class StatusLine:
-    def __init__(self):
+    # `frame`: delay in seconds during which block updates are coalesced
+    # into a single status line, 0 coalesces the updates of one iteration
+    # of the event loop.
+    # `jobs`: size of the thread pool running the blocking calls of blocks
+    # (see `run_blocking`).
+    def __init__(self, frame=0, jobs=2):
         self.blocks = {}
+        self.executor = ThreadPoolExecutor(jobs, thread_name_prefix='block')
+        self.frame = frame
+        self.scheduled = False
+        self.line = None
 
+    # Schedule printing the status line, blocks updated in the meantime are
+    # printed together.
     def print(self):
-        print(',', json.dumps( list(self.blocks.values()) ), flush=True)
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_later(self.frame, self.flush)
+
+    # Print the status line, unless it didn't change since the last one.
+    def flush(self):
+        self.scheduled = False
+        blocks = ', '.join(block.to_json() for block in self.blocks.values())
+        line = f'[{blocks}]'
+        if line != self.line:
+            self.line = line
+            print(',', line, flush=True)
+
+    # Statistics of the blocks by name.
+    def stats(self):
+        return { block['name']: block.stats.as_dict()
+                 for block in self.blocks.values() }
+
+    def dump_stats(self, file=sys.stderr):
+        print(json.dumps(self.stats(), indent=2), file=file, flush=True)
+
+    # Send the statistics to each client connecting to the Unix socket at
+    # `path`, e.g. `socat - UNIX-CONNECT:path`.
+    async def serve_stats(self, path):
+        async def send(reader, writer):
+            writer.write(json.dumps(self.stats(), indent=2).encode() + b'\n')
+            await writer.drain()
+            writer.close()
+        Path(path).unlink(missing_ok=True)
+        await asyncio.start_unix_server(send, path)
+
+    # Run blocking `function` in the thread pool of the blocks.
+    async def run_blocking(self, function, *args):
+        return await self.loop.run_in_executor(self.executor, function, *args)
 
     # Read json click events sent from i3bar to stdin, and send them to the
     # corresponding blocks.
@@ -155,13 +391,14 @@ class StatusLine:
             line = line.lstrip(',')
             event = json.loads(line)
             logging.debug(event)
-            self.blocks[event['instance']].on_click(event)
+            block = self.blocks[event['instance']]
+            self.loop.create_task(block.guard(block.on_click(event)))
 
     # Propagate signal `sig` to all the blocks.
     def signal_handler(self, sig):
         logging.debug(f'signal_handler {sig}')
         for block in self.blocks.values():
-            block.on_signal(sig)
+            self.loop.create_task(block.guard(block.on_signal(sig)))
 
     def add_signal_handler(self, sig):
         self.loop.add_signal_handler(sig, lambda: self.signal_handler(sig))
@@ -171,7 +408,10 @@ class StatusLine:
         self.blocks[block['instance']] = block
         task = self.loop.create_task(block.out_loop())
 
-    def main(self):
+    # `stats`: path of the Unix socket serving the statistics of the blocks,
+    # which are also dumped to stderr on SIGUSR1.
+    # `stats_block`: add the BStats debug block.
+    def main(self, stats=None, stats_block=False):
         # preamble
         # doc: https://i3wm.org/docs/i3bar-protocol.html#_header_in_detail
         print(json.dumps({ "version": 1, "click_events": True, }))
@@ -182,20 +422,34 @@ class StatusLine:
         self.loop = asyncio.get_event_loop()
         self.loop.create_task(self.click_handler())
         self.add_signal_handler(signal.SIGRTMIN+15)
+        self.loop.add_signal_handler(signal.SIGUSR1, self.dump_stats)
+        if stats:
+            self.loop.create_task(self.serve_stats(stats))
         self.add_block(BCPU)
         self.add_block(BRAM)
         self.add_block(BDisk)
         self.add_block(BVolume)
         self.add_block(BNetwork)
         self.add_block(BDateTime)
+        if stats_block:
+            self.add_block(BStats)
         self.loop.run_forever()
 
 if __name__ == "__main__":
-    if '--debug' in sys.argv:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--debug', action='store_true',
+        help='log to dotstatus.log in the user data directory')
+    parser.add_argument('--stats', metavar='SOCKET',
+        help='serve the statistics of the blocks on this Unix socket')
+    parser.add_argument('--stats-block', action='store_true',
+        help='show the statistics of the blocks in the status line')
+    args = parser.parse_args()
+
+    if args.debug:
         logging.basicConfig(
             filename = Path(GLib.get_user_data_dir()) / 'dotstatus.log',
             level    = logging.DEBUG
         )
         logging.debug(f'Start logging {os.getpid()}')
 
-    StatusLine().main()
+    StatusLine().main(stats=args.stats, stats_block=args.stats_block)